@@ -0,0 +1,164 @@
+'''
+Memory benchmark for TSDoc block trees
+
+Parses all pages of the book and keeps their block trees in memory like
+gen-doc.py does, then reports peak resident set size of the process, number
+and size of block tree objects per class (str counts distinct text chunks).
+Results may be saved as JSON to compare them with previous runs:
+
+    python tsdoc/bench-memory.py -o before.json
+    python tsdoc/bench-memory.py -c before.json -o after.json
+
+Should be run from the root of repository because listings paths are relative.
+'''
+
+import os
+import sys
+import glob
+import time
+import json
+import resource
+import platform
+
+from argparse import ArgumentParser
+
+from tsdoc.mdparser2 import MarkdownParser
+from tsdoc.blocks import Block
+
+MB = 1024.0 * 1024.0
+
+def find_pages(book_dir):
+    return sorted(glob.glob(os.path.join(book_dir, '*.md')) +
+                  glob.glob(os.path.join(book_dir, '*', '*.md')))
+
+def get_peak_rss():
+    # ru_maxrss is measured in kilobytes on Linux but in bytes on OS X
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+def count_objects(blocks):
+    # Walks block trees and returns per-class counters of objects and their
+    # sizes. Objects shared between several nodes (like interned strings)
+    # are counted once
+    classes = {}
+    seen = set()
+    
+    def account(obj):
+        if id(obj) in seen:
+            return
+        seen.add(id(obj))
+        
+        name = obj.__class__.__name__
+        stats = classes.setdefault(name, {'count': 0, 'bytes': 0})
+        stats['count'] += 1
+        stats['bytes'] += sys.getsizeof(obj)
+        
+        if hasattr(obj, '__dict__'):
+            account(obj.__dict__)
+        
+        if isinstance(obj, Block):
+            # Do not use obj.parts here: it makes code listings to be read
+            parts = getattr(obj, '_parts', None)
+            if parts is None:
+                parts = obj.parts
+            
+            account(parts)
+            for part in parts:
+                account(part)
+        elif hasattr(obj, 'text'):
+            account(obj.text)
+    
+    for block in blocks:
+        account(block)
+    
+    return classes
+
+def main():
+    argparser = ArgumentParser(description='Measures memory used by TSDoc block trees')
+    argparser.add_argument('book_dir', nargs='?', default='book',
+                           help='Directory containing book pages')
+    argparser.add_argument('-o', '--output',
+                           help='Save results to JSON file')
+    argparser.add_argument('-c', '--compare',
+                           help='Compare results with previously saved JSON file')
+    args = argparser.parse_args()
+    
+    texts = []
+    for path in find_pages(args.book_dir):
+        with open(path) as f:
+            texts.append((path, f.read()))
+    
+    if not texts:
+        print >> sys.stderr, 'No pages found in "%s"' % args.book_dir
+        sys.exit(1)
+    
+    # Page texts are released after parsing, so only block trees remain
+    # in memory when peak RSS is taken
+    start_rss = get_peak_rss()
+    
+    blocks = []
+    for path, text in texts:
+        blocks.extend(MarkdownParser(text, path).parse())
+    size = sum(len(text) for _, text in texts)
+    del texts
+    
+    peak_rss = get_peak_rss()
+    classes = count_objects(blocks)
+    
+    results = {'parser_version': MarkdownParser.VERSION,
+               'python': platform.python_version(),
+               'timestamp': time.time(),
+               'bytes': size,
+               'start_rss': start_rss,
+               'peak_rss': peak_rss,
+               'classes': classes}
+    
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    
+    def delta(new, old):
+        if not old:
+            return ''
+        return ' ({0:+.1f}%)'.format((float(new) / old - 1.0) * 100.0)
+    
+    def old_value(*path):
+        value = baseline
+        try:
+            for name in path:
+                value = value[name]
+        except (KeyError, TypeError):
+            return None
+        return value
+    
+    growth = peak_rss - start_rss
+    old_growth = None
+    if baseline is not None:
+        old_growth = baseline['peak_rss'] - baseline['start_rss']
+    
+    print 'Book: {0:.2f} MB of text'.format(size / MB)
+    print 'Peak RSS: {0:.2f} MB{1}'.format(peak_rss / MB,
+                                           delta(peak_rss, old_value('peak_rss')))
+    print 'Parsed trees: {0:.2f} MB{1}'.format(growth / MB, delta(growth, old_growth))
+    
+    print
+    print '{0:20} {1:>10} {2:>12}'.format('CLASS', 'COUNT', 'BYTES')
+    for name, stats in sorted(classes.items(),
+                              key=lambda kv: kv[1]['bytes'], reverse=True):
+        print '{0:20} {1:10} {2:12}{3}'.format(name, stats['count'], stats['bytes'],
+                                               delta(stats['bytes'],
+                                                     old_value('classes', name, 'bytes')))
+    
+    print '{0:20} {1:10} {2:12}'.format('TOTAL',
+                                        sum(stats['count'] for stats in classes.values()),
+                                        sum(stats['bytes'] for stats in classes.values()))
+    
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
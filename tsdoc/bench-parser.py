@@ -0,0 +1,172 @@
+'''
+Benchmark for TSDoc markdown parser
+
+Times MarkdownParser.parse() over all pages of the book and over synthetic
+documents built by repeating the book text, and counts calls and time spent
+in CHAR_TABLE handlers. Results are printed and may be saved as JSON to
+compare them with previous runs:
+
+    python tsdoc/bench-parser.py -o before.json
+    python tsdoc/bench-parser.py -c before.json -o after.json
+
+Should be run from the root of repository because listings paths are relative.
+'''
+
+import os
+import sys
+import glob
+import time
+import json
+import platform
+
+from argparse import ArgumentParser
+
+from tsdoc.mdparser2 import MarkdownParser
+
+MB = 1024.0 * 1024.0
+
+def find_pages(book_dir):
+    return sorted(glob.glob(os.path.join(book_dir, '*.md')) +
+                  glob.glob(os.path.join(book_dir, '*', '*.md')))
+
+def time_parse(text, name, repeat):
+    # Returns best time of several parser runs
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        MarkdownParser(text, name).parse()
+        elapsed = time.time() - start
+        
+        if best is None or elapsed < best:
+            best = elapsed
+    
+    return best
+
+def make_result(size, elapsed):
+    return {'bytes': size,
+            'time': elapsed,
+            'mbps': (size / MB / elapsed) if elapsed else 0.0}
+
+def bench_pages(texts, repeat):
+    pages = {}
+    total_size, total_time = 0, 0.0
+    
+    for path, text in texts:
+        elapsed = time_parse(text, path, repeat)
+        pages[path] = make_result(len(text), elapsed)
+        
+        total_size += len(text)
+        total_time += elapsed
+    
+    return make_result(total_size, total_time), pages
+
+def bench_synthetic(texts, scale, repeat):
+    # Synthetic document is the whole book repeated scale times, so it keeps
+    # proportions of markup used in real pages
+    corpus = '\n\n'.join(text for _, text in texts)
+    text = '\n\n'.join([corpus] * scale)
+    
+    return make_result(len(text), time_parse(text, 'synthetic-x%d' % scale, repeat))
+
+def profile_handlers(texts):
+    MarkdownParser.reset_profile()
+    MarkdownParser.PROFILE = True
+    
+    try:
+        for path, text in texts:
+            MarkdownParser(text, path).parse()
+    finally:
+        MarkdownParser.PROFILE = False
+    
+    return dict((name, {'calls': calls, 'rejected': rejected, 'time': elapsed})
+                for name, (calls, rejected, elapsed)
+                in MarkdownParser.PROFILE_STATS.items())
+
+def print_results(results, baseline):
+    def delta(key, *path):
+        if baseline is None:
+            return ''
+        
+        try:
+            old = baseline[key]
+            for name in path:
+                old = old[name]
+        except KeyError:
+            return ''
+        
+        new = results[key]
+        for name in path:
+            new = new[name]
+        
+        if not old['mbps']:
+            return ''
+        return ' ({0:+.1f}%)'.format((new['mbps'] / old['mbps'] - 1.0) * 100.0)
+    
+    corpus = results['corpus']
+    print 'Book: {0} pages, {1:.2f} MB, {2:.3f} s, {3:.2f} MB/s{4}'.format(
+                len(results['pages']), corpus['bytes'] / MB, corpus['time'],
+                corpus['mbps'], delta('corpus'))
+    
+    for scale, result in sorted(results['synthetic'].items(), key=lambda kv: int(kv[0])):
+        print 'Synthetic x{0}: {1:.2f} MB, {2:.3f} s, {3:.2f} MB/s{4}'.format(
+                scale, result['bytes'] / MB, result['time'], result['mbps'],
+                delta('synthetic', scale))
+    
+    print
+    print '{0:20} {1:>10} {2:>10} {3:>10}'.format('HANDLER', 'CALLS', 'REJECTED', 'TIME')
+    for name, stats in sorted(results['handlers'].items(),
+                              key=lambda kv: kv[1]['time'], reverse=True):
+        print '{0:20} {1:10} {2:10} {3:10.4f}'.format(name, stats['calls'],
+                                                      stats['rejected'], stats['time'])
+
+def main():
+    argparser = ArgumentParser(description='Benchmarks TSDoc markdown parser')
+    argparser.add_argument('book_dir', nargs='?', default='book',
+                           help='Directory containing book pages')
+    argparser.add_argument('-o', '--output',
+                           help='Save results to JSON file')
+    argparser.add_argument('-c', '--compare',
+                           help='Compare results with previously saved JSON file')
+    argparser.add_argument('-s', '--scales', default='10,100',
+                           help='Comma-separated list of synthetic document scales')
+    argparser.add_argument('-r', '--repeat', type=int, default=3,
+                           help='Number of runs, best time is reported')
+    args = argparser.parse_args()
+    
+    texts = []
+    for path in find_pages(args.book_dir):
+        with open(path) as f:
+            texts.append((path, f.read()))
+    
+    if not texts:
+        print >> sys.stderr, 'No pages found in "%s"' % args.book_dir
+        sys.exit(1)
+    
+    corpus, pages = bench_pages(texts, args.repeat)
+    
+    synthetic = {}
+    for scale in args.scales.split(','):
+        if scale:
+            synthetic[scale] = bench_synthetic(texts, int(scale), args.repeat)
+    
+    results = {'parser_version': MarkdownParser.VERSION,
+               'python': platform.python_version(),
+               'timestamp': time.time(),
+               'corpus': corpus,
+               'pages': pages,
+               'synthetic': synthetic,
+               'handlers': profile_handlers(texts)}
+    
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    
+    print_results(results, baseline)
+    
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
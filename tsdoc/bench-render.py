@@ -0,0 +1,143 @@
+'''
+Benchmark for TSDoc printers
+
+Builds the book index like gen-doc.py does (documents are generated into
+temporary directory, so all links and navigation are resolved), then times
+rendering of all pages into memory with printer's do_print(). Results are
+printed and may be saved as JSON to compare them with previous runs:
+
+    python tsdoc/bench-render.py -o before.json
+    python tsdoc/bench-render.py -c before.json -o after.json
+
+Should be run from the root of repository because listings paths are relative.
+'''
+
+import os
+import sys
+import glob
+import time
+import json
+import shutil
+import tempfile
+import platform
+
+from StringIO import StringIO
+from argparse import ArgumentParser
+
+from tsdoc.page import IndexPage, IncompletePage
+
+MB = 1024.0 * 1024.0
+
+def find_pages(book_dir):
+    return sorted(glob.glob(os.path.join(book_dir, '*', '*.md')))
+
+def create_printer(doc_format, book_dir):
+    if doc_format == 'html':
+        from tsdoc.blocks.html import HTMLPrinter
+        return HTMLPrinter(os.path.join(book_dir, 'template.html')), '.html'
+    elif doc_format == 'markdown':
+        from tsdoc.blocks.markdown import MarkdownPrinter
+        return MarkdownPrinter(), '.out.md'
+    
+    raise ValueError("Invalid documentation format '%s'" % doc_format)
+
+def prepare_pages(book_dir, printer, doc_suffix):
+    # Generates book once to resolve links, then collects pages with
+    # headers they are printed with
+    index_page = IndexPage(os.path.join(book_dir, 'index.md'), 'Benchmark',
+                           find_pages(book_dir), 1)
+    
+    doc_dir = tempfile.mkdtemp(prefix='tsdoc-bench-')
+    try:
+        index_page.generate(printer, doc_dir, doc_suffix, 1, None)
+    finally:
+        shutil.rmtree(doc_dir)
+    
+    pages = [(index_page.header, index_page)]
+    seen = set([id(index_page)])
+    
+    for docspace in index_page.docspaces:
+        for page in [docspace] + docspace.pages.values():
+            if id(page) in seen or isinstance(page, IncompletePage):
+                continue
+            
+            seen.add(id(page))
+            pages.append((docspace.header, page))
+    
+    if index_page.reference is not None:
+        pages.append((index_page.reference.header, index_page.reference))
+    
+    return pages
+
+def time_render(printer, pages, repeat):
+    # Returns best time of several renders of all pages and size of output
+    best = None
+    for _ in xrange(repeat):
+        size = 0
+        
+        start = time.time()
+        for header, page in pages:
+            stream = StringIO()
+            printer.do_print(stream, header, page)
+            size += len(stream.getvalue())
+        elapsed = time.time() - start
+        
+        if best is None or elapsed < best:
+            best = elapsed
+    
+    return size, best
+
+def main():
+    argparser = ArgumentParser(description='Benchmarks TSDoc printers')
+    argparser.add_argument('book_dir', nargs='?', default='book',
+                           help='Directory containing book pages')
+    argparser.add_argument('-f', '--format', default='html',
+                           help='Output format: html or markdown')
+    argparser.add_argument('-o', '--output',
+                           help='Save results to JSON file')
+    argparser.add_argument('-c', '--compare',
+                           help='Compare results with previously saved JSON file')
+    argparser.add_argument('-r', '--repeat', type=int, default=5,
+                           help='Number of runs, best time is reported')
+    args = argparser.parse_args()
+    
+    printer, doc_suffix = create_printer(args.format, args.book_dir)
+    
+    # Warnings about links are not interesting here
+    stderr, sys.stderr = sys.stderr, StringIO()
+    try:
+        pages = prepare_pages(args.book_dir, printer, doc_suffix)
+    finally:
+        sys.stderr = stderr
+    
+    size, elapsed = time_render(printer, pages, args.repeat)
+    
+    results = {'format': args.format,
+               'python': platform.python_version(),
+               'timestamp': time.time(),
+               'pages': len(pages),
+               'bytes': size,
+               'time': elapsed,
+               'pages_per_sec': len(pages) / elapsed if elapsed else 0.0,
+               'mbps': size / MB / elapsed if elapsed else 0.0}
+    
+    delta = ''
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        
+        if baseline.get('mbps'):
+            delta = ' ({0:+.1f}%, x{1:.2f})'.format(
+                        (results['mbps'] / baseline['mbps'] - 1.0) * 100.0,
+                        results['mbps'] / baseline['mbps'])
+    
+    print 'Rendered {0} pages as {1}: {2:.2f} MB, {3:.3f} s, {4:.1f} pages/s, {5:.2f} MB/s{6}'.format(
+                results['pages'], args.format, size / MB, elapsed,
+                results['pages_per_sec'], results['mbps'], delta)
+    
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,47 +1,122 @@
 import os
 import sys
+import copy
+import json
+import multiprocessing
 
 from collections import defaultdict, OrderedDict
 
 from tsdoc import TSDoc
 from tsdoc.page import MarkdownPage, IndexPage
+from tsdoc.mdparser2 import MarkdownParseError
+from tsdoc.bundle import BookBundle
 
 from tsdoc.blocks import Link
-from tsdoc.blocks.markdown import MarkdownPrinter
-from tsdoc.blocks.html import HTMLPrinter
-from tsdoc.blocks.latex import LatexPrinter
-from tsdoc.blocks.pdf import PDFPrinter
-from tsdoc.blocks.epub import EpubPrinter
+
+def create_printer(doc_format):
+    # Printers are imported only when needed because they depend on 
+    # PIL, reportlab, etc.
+    if doc_format == 'html':
+        from tsdoc.blocks.html import HTMLPrinter
+        return HTMLPrinter(os.getenv('TSDOC_HTML_TEMPLATE')), '.html'
+    elif doc_format == 'markdown':
+        from tsdoc.blocks.markdown import MarkdownPrinter
+        return MarkdownPrinter(), '.out.md'
+    elif doc_format == 'latex':
+        from tsdoc.blocks.latex import LatexPrinter
+        return LatexPrinter(), '.tex'
+    elif doc_format == 'pdf':
+        from tsdoc.blocks.pdf import PDFPrinter
+        return PDFPrinter(), '.pdf'
+    elif doc_format == 'epub':
+        from tsdoc.blocks.epub import EpubPrinter
+        return EpubPrinter(), '.epub'
+    
+    raise ValueError("Invalid documentation format '%s'" % doc_format)
+
+def generate(index_page, output):
+    doc_format, printer, doc_dir, doc_suffix, depgraph_path = output
+    
+    index_page.generate(printer, doc_dir, doc_suffix, jobs, depgraph_path)
+    
+    if not printer.single_doc:
+        print '\n%sWritten %d files, skipped %d unchanged files' % (
+                    '%s: ' % doc_format if len(outputs) > 1 else '',
+                    index_page.written, index_page.unchanged)
+
+def generate_all(index_page, outputs):
+    if len(outputs) == 1:
+        generate(index_page, outputs[0])
+        return
+    
+    # Each printer needs its own copy of the tree because links are resolved
+    # in place. Forked processes get it for free (pages are copied on write),
+    # otherwise tree is deep-copied and printers are run one by one
+    if not hasattr(os, 'fork'):
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+        
+        for output in outputs:
+            generate(copy.deepcopy(index_page), output)
+        return
+    
+    processes = []
+    for output in outputs:
+        process = multiprocessing.Process(target=generate, 
+                                          args=(index_page, output))
+        process.start()
+        processes.append((output[0], process))
+    
+    failed = []
+    for doc_format, process in processes:
+        process.join()
+        if process.exitcode != 0:
+            failed.append(doc_format)
+    
+    if failed:
+        print >> sys.stderr, 'ERROR: Failed to generate %s' % ', '.join(failed)
+        sys.exit(1)
 
 # Main code
 _ = sys.argv.pop(0)
-index_path = sys.argv.pop(0) 
 
-# Destination dir
-doc_dir = os.path.dirname(index_path)
+# Check mode: validate links, anchors, images and listings without creating
+# printer or writing documents. Prints JSON report and exits with non-zero 
+# code if any errors were found
+check_mode = sys.argv[0] == '--check'
+if check_mode:
+    sys.argv.pop(0)
+
+index_path = sys.argv.pop(0) 
 
-# Output format
-doc_format = os.getenv('TSDOC_FORMAT', 'html')
 doc_header = os.getenv('TSDOC_HEADER', '')
 verbose = os.getenv('TSDOC_VERBOSE', None) is not None
+jobs = int(os.getenv('TSDOC_JOBS', 0)) or None
+bundle_path = os.getenv('TSDOC_BUNDLE', None)
+depgraph_path = os.getenv('TSDOC_DEPGRAPH', None)
 
-if doc_format == 'html':
-    doc_suffix = '.html'
-    printer = HTMLPrinter(os.getenv('TSDOC_HTML_TEMPLATE'))
-elif doc_format == 'markdown':
-    doc_suffix = '.out.md'
-    printer = MarkdownPrinter()
-elif doc_format == 'latex':
-    doc_suffix = '.tex'
-    printer = LatexPrinter()
-elif doc_format == 'pdf':
-    doc_suffix = '.pdf'
-    printer = PDFPrinter()
-elif doc_format == 'epub':
-    doc_suffix = '.epub'
-    printer = EpubPrinter()
-else:
-    raise ValueError("Invalid documentation format '%s'" % doc_format)
+# Output formats: comma-separated list of formats, each may be followed
+# by destination dir, i.e. "html,pdf:build/pdf". By default documents are 
+# written to the directory of index page. All formats are generated from 
+# the same parsed pages
+outputs = []
+if not check_mode:
+    doc_formats = os.getenv('TSDOC_FORMAT', 'html').split(',')
+    
+    for doc_format in doc_formats:
+        doc_format, _, doc_dir = doc_format.strip().partition(':')
+        if not doc_dir:
+            doc_dir = os.path.dirname(index_path)
+        
+        printer, doc_suffix = create_printer(doc_format)
+        
+        # Dependency graphs of different printers are kept in separate files
+        format_depgraph_path = depgraph_path
+        if depgraph_path and len(doc_formats) > 1:
+            root, ext = os.path.splitext(depgraph_path)
+            format_depgraph_path = '%s-%s%s' % (root, doc_format, ext)
+        
+        outputs.append((doc_format, printer, doc_dir, 
+                        doc_suffix, format_depgraph_path))
 
 pages = defaultdict(OrderedDict)
 tsdoc_pages = []
@@ -49,24 +124,67 @@ tsdoc_pages = []
 if verbose:
     print 'Parsing ', 
 
+page_paths = []
 for page_path in sys.argv:
     page_name = os.path.basename(page_path)
-    print page_name, 
+    if not check_mode:
+        print page_name, 
     if page_path.endswith('.md'):
-        page = MarkdownPage(page_path)
-    
-    pages[page.docspace][page.name] = page
+        page_paths.append(page_path)
 
-if verbose:
-    print '\nProcessing',
+if check_mode:
+    # Pages are parsed one by one to report all pages which can't be parsed
+    errors = []
+    
+    for page_path in page_paths:
+        try:
+            page = MarkdownPage(page_path)
+        except MarkdownParseError as e:
+            errors.append({'type': 'parse', 'page': page_path, 
+                           'target': None, 'text': str(e)})
+            continue
+        
+        pages[page.docspace][page.name] = page
+    
+    index_page = IndexPage(index_path, doc_header, pages)
+    counts, link_errors = index_page.check(os.getenv('TSDOC_IMGDIR'))
+    errors.extend(link_errors)
+    
+    json.dump({'checked': counts, 'errors': errors}, sys.stdout, 
+              indent=2, sort_keys=True)
+    print
+    
+    sys.exit(1 if errors else 0)
 
-for page in tsdoc_pages:
-    print '%s/%s' % (page.docspace, page.name),
-    page.process()
+# Book bundle keeps pages already parsed and indexed by previous run 
+# (probably for another format), so only rendering is left to do
+index_page = None
+if bundle_path:
+    bundle = BookBundle(bundle_path)
+    bundle_key = BookBundle.get_key(index_path, page_paths, doc_header)
+    index_page = bundle.load(bundle_key)
+    
+    if verbose and index_page is not None:
+        print '\nLoaded book bundle %s' % bundle_path
 
-if verbose:
-    print '\nBuilding index...'
+if index_page is None:
+    if verbose:
+        print '\nProcessing',
+    
+    for page in tsdoc_pages:
+        print '%s/%s' % (page.docspace, page.name),
+        page.process()
+    
+    if verbose:
+        print '\nBuilding index...'
+    
+    # Build indexes and Cross-References. Index page parses only pages
+    # of docspaces it includes, so other docspaces are skipped
+    index_page = IndexPage(index_path, doc_header, page_paths, jobs)
+    
+    # Bundle is stored before generating documents because generate() 
+    # resolves links and adds navigation, so it changes pages
+    if bundle_path:
+        bundle.store(bundle_key, index_page)
 
-# Build indexes and Cross-References
-index_page = IndexPage(index_path, doc_header, pages)
-index_page.generate(printer, doc_dir, doc_suffix)
\ No newline at end of file
+generate_all(index_page, outputs)
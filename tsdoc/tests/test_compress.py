@@ -0,0 +1,63 @@
+'''
+Tests for Precompressor
+
+Documents directory of the book also contains sources such as template.html,
+so only files written by the build should get compressed copies.
+
+Run from tsdoc directory:
+
+    python -m unittest discover tests
+'''
+
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+
+from tsdoc.compress import Precompressor
+
+class PrecompressorTest(unittest.TestCase):
+    def setUp(self):
+        self.doc_dir = tempfile.mkdtemp(prefix='tsdoc-test-')
+        
+        os.makedirs(os.path.join(self.doc_dir, 'intro'))
+        
+        self.write('template.html', '<html>${BODY}</html>')
+        self.write('intro/page.html', '<html>Page</html>')
+        self.write('intro/other.html', '<html>Other</html>')
+    
+    def tearDown(self):
+        shutil.rmtree(self.doc_dir)
+    
+    def write(self, name, text):
+        with open(os.path.join(self.doc_dir, name), 'w') as f:
+            f.write(text)
+    
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.doc_dir, name))
+    
+    def test_source_left_alone(self):
+        compressed = Precompressor(self.doc_dir, 1).run(['intro/page.html'])
+        
+        self.assertEqual(compressed, 1)
+        self.assertTrue(self.exists('intro/page.html.gz'))
+        self.assertFalse(self.exists('intro/other.html.gz'))
+        self.assertFalse(self.exists('template.html.gz'))
+        
+        with gzip.open(os.path.join(self.doc_dir, 'intro/page.html.gz')) as f:
+            self.assertEqual(f.read(), '<html>Page</html>')
+    
+    def test_unchanged_and_stale(self):
+        outputs = ['intro/page.html', 'intro/other.html']
+        self.assertEqual(Precompressor(self.doc_dir, 1).run(outputs), 2)
+        self.assertEqual(Precompressor(self.doc_dir, 1).run(outputs), 0)
+        
+        # Copies of files which are not written by the build anymore
+        # are removed
+        self.assertEqual(Precompressor(self.doc_dir, 1).run(outputs[:1]), 0)
+        self.assertTrue(self.exists('intro/page.html.gz'))
+        self.assertFalse(self.exists('intro/other.html.gz'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+'''
+Tests for HTMLPrinter with image catalog and hashed assets
+
+Builds a small book which contains an image and non-ASCII text, so byte
+strings of page are mixed with strings loaded from catalog.
+
+Run from tsdoc directory:
+
+    python -m unittest discover tests
+'''
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+try:
+    import PIL.Image
+except ImportError:
+    PIL = None
+
+if PIL is not None:
+    from tsdoc import images
+    from tsdoc.page import IndexPage
+    from tsdoc.images import ImageCatalog
+    from tsdoc.blocks.html import HTMLPrinter
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(__file__),
+                             '..', '..', 'book', 'template.html')
+
+INDEX_TEXT = '''Test book
+
+### Introduction
+[__docspace__:intro]
+
+ * [Page][intro/page]
+'''
+
+PAGE_TEXT = '''### [__index__:DTrace] DTrace
+
+Image \xe2\x80\x94 caption
+
+![image:dtrace](dtrace.png)
+'''
+
+def create_png(path, width, height):
+    ''' Writes PNG image filled with black color '''
+    def chunk(tag, data):
+        crc = zlib.crc32(tag + data) & 0xffffffff
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', crc)
+    
+    rows = ('\0' + '\0\0\0' * width) * height
+    
+    with open(path, 'wb') as f:
+        f.write('\x89PNG\r\n\x1a\n')
+        f.write(chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk('IDAT', zlib.compress(rows)))
+        f.write(chunk('IEND', ''))
+
+@unittest.skipIf(PIL is None, 'PIL is not installed')
+class HashedImagesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='tsdoc-test-')
+        
+        self.book_dir = os.path.join(self.tmp_dir, 'book')
+        self.image_dir = os.path.join(self.tmp_dir, 'images')
+        self.doc_dir = os.path.join(self.tmp_dir, 'doc')
+        self.catalog_path = os.path.join(self.tmp_dir, 'images.json')
+        self.depgraph_path = os.path.join(self.tmp_dir, 'deps.json')
+        
+        os.makedirs(os.path.join(self.book_dir, 'intro'))
+        os.makedirs(self.image_dir)
+        os.makedirs(self.doc_dir)
+        
+        self.index_path = os.path.join(self.book_dir, 'index.md')
+        self.page_path = os.path.join(self.book_dir, 'intro', 'page.md')
+        
+        with open(self.index_path, 'w') as f:
+            f.write(INDEX_TEXT)
+        with open(self.page_path, 'w') as f:
+            f.write(PAGE_TEXT)
+        
+        create_png(os.path.join(self.image_dir, 'dtrace.png'), 40, 30)
+        create_png(os.path.join(self.image_dir, 'dtrace.20w.png'), 20, 15)
+        
+        # Image directory and catalog are configured like gen-doc.py 
+        # gets them from environment
+        self.old_env = os.environ.get('TSDOC_IMGDIR')
+        self.old_image_path = HTMLPrinter.IMAGE_PATH
+        self.old_catalog_path = images.CATALOG_PATH
+        
+        os.environ['TSDOC_IMGDIR'] = self.image_dir
+        HTMLPrinter.IMAGE_PATH = self.image_dir
+        images.CATALOG_PATH = self.catalog_path
+    
+    def tearDown(self):
+        if self.old_env is None:
+            del os.environ['TSDOC_IMGDIR']
+        else:
+            os.environ['TSDOC_IMGDIR'] = self.old_env
+        
+        HTMLPrinter.IMAGE_PATH = self.old_image_path
+        images.CATALOG_PATH = self.old_catalog_path
+        ImageCatalog._catalogs.clear()
+        
+        shutil.rmtree(self.tmp_dir)
+    
+    def build(self):
+        ''' Generates book like gen-doc.py does. Each run of gen-doc.py
+        creates catalog once, so it is forgotten after build and 
+        subsequent builds load it from file '''
+        ImageCatalog._catalogs.clear()
+        
+        printer = HTMLPrinter(TEMPLATE_PATH)
+        printer.HASH_ASSETS = True
+        
+        index_page = IndexPage(self.index_path, 'Test', [self.page_path], 1)
+        index_page.generate(printer, self.doc_dir, '.html', 1, self.depgraph_path)
+        
+        with open(os.path.join(self.doc_dir, 'intro', 'page.html')) as f:
+            return f.read()
+    
+    def test_rebuild_with_loaded_catalog(self):
+        self.build()
+        self.assertTrue(os.path.exists(self.catalog_path))
+        
+        # Page is printed again with image hashes loaded from catalog file
+        with open(self.page_path, 'a') as f:
+            f.write('\nMore text\n')
+        
+        text = self.build()
+        self.assertIn('More text', text)
+        self.assertIn('\xe2\x80\x94', text)
+        
+        digest = ImageCatalog(self.image_dir, self.catalog_path).get('dtrace.png').hash
+        self.assertIn('images/dtrace.%s.png' % digest[:10], text)
+        self.assertIn('images/dtrace.20w.', text)
+        self.assertIn('width="40" height="30"', text)
+    
+    def test_new_scaled_copy(self):
+        self.assertNotIn('dtrace.80w', self.build())
+        
+        # Page is not changed, but it is printed again with new copy in srcset
+        create_png(os.path.join(self.image_dir, 'dtrace.80w.png'), 80, 60)
+        self.assertIn('dtrace.80w', self.build())
+
+    def test_stale_copy_removed(self):
+        self.build()
+        
+        image_path = os.path.join(self.image_dir, 'dtrace.png')
+        digest = ImageCatalog(self.image_dir, self.catalog_path).get('dtrace.png').hash
+        old_copy = os.path.join(self.doc_dir, 'images', 'dtrace.%s.png' % digest[:10])
+        self.assertTrue(os.path.exists(old_copy))
+        
+        # Changed image gets new hashed copy and old one is not used anymore
+        create_png(image_path, 50, 30)
+        self.assertIn('width="50" height="30"', self.build())
+        self.assertFalse(os.path.exists(old_copy))
+    
+    def test_hash_like_name(self):
+        # Image which name looks like a name of hashed copy is not one
+        create_png(os.path.join(self.image_dir, 'trace.0123456789.png'), 10, 10)
+        self.build()
+        
+        image = ImageCatalog(self.image_dir, self.catalog_path).get('trace.0123456789.png')
+        self.assertEqual((image.width, image.height), (10, 10))
+        self.assertTrue(os.path.exists(os.path.join(self.doc_dir, 'images', 
+                                                    'trace.0123456789.%s.png' % image.hash[:10])))
+
+if __name__ == '__main__':
+    unittest.main()
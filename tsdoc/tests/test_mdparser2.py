@@ -0,0 +1,208 @@
+'''
+Tests for MarkdownParser block trees
+
+Each document in fixtures/ directory has a tree with the same name and
+'.tree' suffix which was dumped by the parser before block classes got
+__slots__ and tables got the fast path (commit 6e2f6cf), so they cover
+tables, code listings, nested lists and inline markup. After intended
+changes of parser output, trees are dumped again by dump_tree().
+
+Tables are also parsed twice: by MarkdownParser and by parser which never
+takes table fast path, so tables are parsed by _post_pop_row() and
+_post_pop_cell() callbacks. Trees should be the same, tests also check
+which way table was actually parsed.
+
+Run from tsdoc directory:
+
+    python -m unittest discover tests
+'''
+
+import os
+import ast
+import glob
+import unittest
+
+from tsdoc.blocks import Block, CodeListing
+from tsdoc.mdparser2 import MarkdownParser
+
+FAST = 'fast'
+RESUMED = 'resumed'
+CALLBACKS = 'callbacks'
+
+BOOK_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'book')
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+class TracingParser(MarkdownParser):
+    ''' Records how each table was parsed '''
+    def __init__(self, text, name=''):
+        MarkdownParser.__init__(self, text, name)
+        self.table_paths = []
+    
+    def _parse_table(self, table, idx):
+        eidx = MarkdownParser._parse_table(self, table, idx)
+        
+        if eidx is None:
+            self.table_paths.append(CALLBACKS)
+        elif table in self.stack:
+            # Fast path gave up in the middle of the table
+            self.table_paths.append(RESUMED)
+        else:
+            self.table_paths.append(FAST)
+        
+        return eidx
+
+class CallbackParser(MarkdownParser):
+    def _parse_table(self, table, idx):
+        return None
+
+def get_attrs(part):
+    ''' Returns sorted pairs of attribute names and values. Parser before
+    block classes got __slots__ kept attributes in __dict__, so both are
+    walked and trees dumped by older parser may be saved as fixtures '''
+    names = set(getattr(part, '__dict__', ()))
+    for cls in type(part).__mro__:
+        names.update(getattr(cls, '__slots__', ()))
+    
+    return sorted((name, getattr(part, name)) for name in names
+                  if name not in ('parts', '_parts', '_loaded_parts'))
+
+def dump_part(part):
+    ''' Returns nested tuples with classes and attributes of parts. Code
+    listings are not loaded, so they are represented by file names '''
+    if isinstance(part, CodeListing):
+        return ('CodeListing', part.fname)
+    
+    if isinstance(part, basestring):
+        return part
+    
+    if not isinstance(part, Block):
+        return (type(part).__name__, get_attrs(part))
+    
+    return ((type(part).__name__, get_attrs(part)) + 
+            tuple(dump_part(child) for child in part.parts))
+
+def dump_tree(blocks):
+    return [dump_part(block) for block in blocks]
+
+class FixtureTreeTest(unittest.TestCase):
+    def assertFixture(self, name):
+        path = os.path.join(FIXTURES_DIR, name)
+        
+        with open(path + '.md') as f:
+            text = f.read()
+        with open(path + '.tree') as f:
+            expected = ast.literal_eval(f.read())
+        
+        self.assertEqual(dump_tree(MarkdownParser(text, path).parse()),
+                         expected)
+    
+    def test_tables(self):
+        self.assertFixture('tables')
+    
+    def test_listings(self):
+        self.assertFixture('listings')
+    
+    def test_lists(self):
+        self.assertFixture('lists')
+    
+    def test_inline(self):
+        self.assertFixture('inline')
+
+class TableFastPathTest(unittest.TestCase):
+    def assertTable(self, text, paths):
+        parser = TracingParser(text)
+        tree = dump_tree(parser.parse())
+        
+        self.assertEqual(tree, dump_tree(CallbackParser(text).parse()))
+        self.assertEqual(parser.table_paths, paths)
+    
+    def test_simple(self):
+        self.assertTable('--- %50,50\n'
+                         'a | b\n'
+                         'c | d\n'
+                         '---\n', [FAST])
+    
+    def test_formatted_cells(self):
+        self.assertTable('Text before\n\n'
+                         '--- %10,10,20\n'
+                         '2,1 __Unit__ | __Description__\n'
+                         'ns | `nsec` | _nanoseconds_\n'
+                         'us | [usec][lang/time] | \\| escaped\n'
+                         '---\n\n'
+                         'Text after\n', [FAST])
+    
+    def test_empty_cells(self):
+        self.assertTable('---\n'
+                         'a | | \n'
+                         '| b |\n'
+                         '---\n', [FAST])
+    
+    def test_several_tables(self):
+        self.assertTable('---\na | b\n---\n\n'
+                         '---\nc | d\n---\n', [FAST, FAST])
+    
+    def test_span(self):
+        self.assertTable('---\n'
+                         'a | ___#f00 red___ | c\n'
+                         '---\n', [CALLBACKS])
+    
+    def test_code_block(self):
+        self.assertTable('---\n'
+                         'a | b\n'
+                         '```\n'
+                         'code | code\n'
+                         '```\n'
+                         '---\n', [CALLBACKS])
+    
+    def test_incut(self):
+        self.assertTable('---\n'
+                         'a | b\n'
+                         '!!! NOTE\n'
+                         'note | text\n'
+                         '!!!\n'
+                         '---\n', [CALLBACKS])
+    
+    def test_list_entries(self):
+        self.assertTable('* item\n'
+                         '---\n'
+                         'a | b\n'
+                         '* c | d\n'
+                         '---\n', [CALLBACKS])
+    
+    def test_unclosed(self):
+        self.assertTable('---\n'
+                         'a | b\n', [CALLBACKS])
+    
+    def test_outer_tail(self):
+        # Tail of enclosing incut occurs in the table, even though it is
+        # escaped there, so table is left to callbacks
+        self.assertTable('!!! NOTE\n'
+                         '---\n'
+                         'a | \\!!! b\n'
+                         '---\n'
+                         '!!!\n', [CALLBACKS])
+    
+    def test_open_link(self):
+        # Links which are not closed in their cells stop fast path
+        # in the middle of the table
+        self.assertTable('text ---\n'
+                         '[ref](\n'
+                         '(\n'
+                         '---\n', [RESUMED])
+        self.assertTable('---\n'
+                         '![image](image.png)(\n'
+                         '[ref]\n'
+                         '\n'
+                         '---\n', [RESUMED])
+    
+    def test_book_pages(self):
+        for path in glob.glob(os.path.join(BOOK_DIR, '*', '*.md')):
+            with open(path) as f:
+                text = f.read()
+            
+            self.assertEqual(dump_tree(MarkdownParser(text, path).parse()),
+                             dump_tree(CallbackParser(text, path).parse()), 
+                             path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+'''
+TSDoc asset manifest
+
+Copies static files used by generated documents (images, stylesheets) to
+names which contain hash of their contents, i.e. images/dtrace.png becomes
+images/dtrace.0123456789.png, so they may be served with long cache
+lifetimes: when file is changed, documents will refer to another name.
+
+Manifest which maps original names (relative to documents directory) to
+hashed names is saved as assets.json in documents directory. Hashed copies
+are created only once and never changed. Copies which are not listed in
+manifest anymore are removed when it is saved, so only names from the
+manifest are treated as hashed copies: real files may have names which
+look like hashed ones.
+'''
+
+import os
+import json
+import shutil
+import hashlib
+
+class AssetManifest(object):
+    MANIFEST_NAME = 'assets.json'
+    HASH_LENGTH = 10
+    
+    def __init__(self, doc_dir):
+        self.doc_dir = doc_dir
+        self.path = os.path.join(doc_dir, self.MANIFEST_NAME)
+        
+        self.assets = {}
+        self.old_assets = {}
+        
+        try:
+            with open(self.path) as f:
+                self.old_assets = json.load(f)
+        except (IOError, ValueError):
+            pass
+        
+        self.hashed_names = set(self.old_assets.values())
+    
+    def is_hashed_name(self, name):
+        ''' Returns True if name relative to documents directory is
+        a name of hashed copy of an asset '''
+        return name in self.hashed_names
+    
+    @staticmethod
+    def get_hashed_name(name, digest):
+        base, ext = os.path.splitext(name)
+        return '%s.%s%s' % (base, digest[:AssetManifest.HASH_LENGTH], ext)
+    
+    @staticmethod
+    def _hash_file(path):
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    
+    def add(self, name, src_path=None, digest=None):
+        ''' Adds asset with name relative to documents directory and returns
+        its hashed name. If file is located outside of documents directory
+        src_path should be specified. If digest is already known (i.e. from
+        image catalog), it is not computed again '''
+        if src_path is None:
+            src_path = os.path.join(self.doc_dir, name)
+        if digest is None:
+            digest = self._hash_file(src_path)
+        
+        hashed_name = self.get_hashed_name(name, digest)
+        path = os.path.join(self.doc_dir, hashed_name)
+        
+        if not os.path.exists(path):
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            
+            tmp_path = '%s.%d' % (path, os.getpid())
+            shutil.copyfile(src_path, tmp_path)
+            os.rename(tmp_path, path)
+        
+        self.assets[name] = hashed_name
+        self.hashed_names.add(hashed_name)
+        return hashed_name
+    
+    def get(self, name):
+        ''' Returns hashed name of asset or name itself if asset
+        wasn't added to manifest '''
+        return self.assets.get(name, name)
+    
+    def save(self):
+        ''' Saves manifest and removes hashed copies of assets which were
+        not added to it since it was loaded '''
+        if self.assets == self.old_assets:
+            return
+        
+        tmp_path = '%s.%d' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.assets, f, indent=1, sort_keys=True)
+        
+        os.rename(tmp_path, self.path)
+        
+        hashed_names = set(self.assets.values())
+        for hashed_name in set(self.old_assets.values()) - hashed_names:
+            path = os.path.join(self.doc_dir, hashed_name)
+            if os.path.exists(path):
+                os.remove(path)
+        
+        self.old_assets = dict(self.assets)
+        self.hashed_names = hashed_names
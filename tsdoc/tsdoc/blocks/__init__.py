@@ -9,6 +9,13 @@ Two main classes:
 By default renders into plain text via __str__, use tsdoc.printer, to
 create formatted text.
 
+Block tree of a book contains hundreds of thousands of nodes which are kept
+in memory by IndexPage, so node classes define __slots__ instead of having
+per-instance __dict__, and text is interned with intern_text() because same
+short chunks (newlines, spaces, punctuation, names of probes and functions)
+are repeated all over the book. Every subclass should define __slots__ too,
+otherwise its instances get __dict__ back.
+
 For example:
 
 Block(Header(1, "Recomendation"]),
@@ -31,13 +38,26 @@ int a = 777;
 import sys
 import string
 
+from tsdoc.listing import listing_store
+
+def intern_text(text):
+    ''' Returns interned copy of text chunk. Only byte strings may be interned,
+    so unicode strings are returned as is '''
+    if type(text) is str:
+        return intern(text)
+    return text
+
 class LineBreak(object):
+    __slots__ = ()
+    
     def __str__(self):
         return '\n'
 
 class Text(object):
+    __slots__ = ('text', )
+    
     def __init__(self, text):
-        self.text = text
+        self.text = intern_text(text)
     
     def __str__(self):
         return self.text
@@ -47,22 +67,26 @@ class Text(object):
                            repr(self.text))
 
 class BreakLine(Text):
+    __slots__ = ()
+    
     def __init__(self, text):
         Text.__init__(self, '')
 
 class BoldText(Text):
-    pass
+    __slots__ = ()
 
 class ItalicText(Text):
-    pass
+    __slots__ = ()
 
 class BoldItalicText(Text):
-    pass
+    __slots__ = ()
 
 class InlineCode(Text):
-    pass
+    __slots__ = ()
 
 class Reference(Text):
+    __slots__ = ()
+    
     def __str__(self):
         return ''
     
@@ -76,12 +100,16 @@ class Reference(Text):
         
         return self.text, None
     
+    # Whitespace and punctuation are replaced in anchor names
+    NAME_TABLE = string.maketrans(string.whitespace + string.punctuation,
+                                  '_' * len(string.whitespace + string.punctuation))
+    
     def get_name(self):
-        return ''.join((c if c not in (string.whitespace + string.punctuation)
-                        else '_')
-                       for c in self.text)
+        return self.text.translate(self.NAME_TABLE)
     
 class Label(Text):
+    __slots__ = ('style', )
+    
     def __init__(self, text, style):
         Text.__init__(self, text)
         self.style = style
@@ -95,6 +123,8 @@ class Link(Text):
     EXTERNAL = 1
     INVALID = 2
     
+    __slots__ = ('type', 'where')
+    
     def __init__(self, text, type, where):
         Text.__init__(self, text)
         self.type = type
@@ -106,9 +136,11 @@ class Link(Text):
                                    repr(self.text))
 
 class Image(Link):
-    pass
+    __slots__ = ()
 
 class Block(object):
+    __slots__ = ('parts', )
+    
     def __init__(self, parts = []):
         if parts:
             self.parts = parts
@@ -125,6 +157,8 @@ class Block(object):
         return iter(self.parts)
 
 class PageSpacer(Block):
+    __slots__ = ('height', 'isbreak', 'iscond', 'style')
+    
     def __init__(self, height=0, isbreak=False, iscond=False, style=None, parts = []):
         self.height = height
         self.isbreak = isbreak
@@ -133,33 +167,41 @@ class PageSpacer(Block):
         Block.__init__(self, parts)
 
 class Header(Block):
+    __slots__ = ('size', )
+    
     def __init__(self, size, parts = []):
         self.size = size
         Block.__init__(self, parts)
 
 class ListEntry(Block):
+    __slots__ = ('level', )
+    
     def __init__(self, level, parts = []):
         self.level = level
         Block.__init__(self, parts)
 
 class ListBlock(Block):
-    pass
+    __slots__ = ()
 
 class Paragraph(Block):
-    pass
+    __slots__ = ()
 
 class Code(Paragraph):
-    pass
+    __slots__ = ()
 
 class Table(Block):
+    __slots__ = ('colwidths', )
+    
     def __init__(self, colwidths = None, parts = []):
         Block.__init__(self, parts)
         self.colwidths = colwidths
 
 class TableRow(Block):
-    pass
+    __slots__ = ()
 
 class TableCell(Block):
+    __slots__ = ('colspan', 'rowspan')
+    
     def __init__(self, colspan = 1, rowspan = 1, parts = []):
         Block.__init__(self, parts)
         
@@ -167,26 +209,60 @@ class TableCell(Block):
         self.rowspan = rowspan
 
 class BlockQuote(Block):
-    pass
+    __slots__ = ()
 
 class CodeListing(Code):
+    ''' Listing of source file. Unless parts are specified explicitly, 
+    they are loaded from listing store on first access. Loaded parts
+    are not pickled, so cached trees do not embed listing bodies '''
+    __slots__ = ('fname', '_parts', '_loaded_parts')
+    
     def __init__(self, fname = '', parts = []):
+        self._loaded_parts = None
         Code.__init__(self, parts)
         
         self.fname = fname
+    
+    def _get_parts(self):
+        if self._parts or not self.fname:
+            return self._parts
+        
+        if self._loaded_parts is None:
+            self._loaded_parts = [listing_store.get(self.fname).get_text().strip()]
+        return self._loaded_parts
+    
+    def _set_parts(self, parts):
+        self._parts = parts
+    
+    parts = property(_get_parts, _set_parts)
+    
+    # Protocol 2 of pickle saves all slots including inherited 'parts',
+    # which would load the listing, so state is defined explicitly
+    def __getstate__(self):
+        return self.fname, self._parts
+    
+    def __setstate__(self, state):
+        self.fname, self._parts = state
+        self._loaded_parts = None
 
 class Incut(Block):
+    __slots__ = ('style', )
+    
     def __init__(self, style, parts = []):
         Block.__init__(self, parts)
         
         self.style = style
 
 class FlowableIncut(Block):
+    __slots__ = ('coords', )
+    
     def __init__(self, coords, parts = []):
         Block.__init__(self, parts)
         self.coords = coords
 
 class Span(Block):
+    __slots__ = ('style', )
+    
     def __init__(self, style=None, parts=[]):
         Block.__init__(self, parts)
         
@@ -199,11 +275,66 @@ class NavLink(object):
     HOME = 3
     REF  = 4
     
+    __slots__ = ('type', 'page', 'where')
+    
     def __init__(self, type, page, where):
         self.type = type
         self.page = page
         self.where = where
 
+class PartIndex(object):
+    ''' Index of parts of a page which are used by cross-referencing
+    and printers, built in a single walk over page blocks.
+    
+    Each list contains pairs (part, parents) in order of their appearance
+    in the page, where parents is a tuple of blocks containing part starting
+    with top-level block, so parents[-1] is a parent block of the part. 
+    Images are also indexed as links. Code listings are not walked into
+    because their text is loaded lazily.'''
+    
+    def __init__(self, blocks):
+        self.internal_links = []
+        self.external_links = []
+        self.references = []
+        self.images = []
+        self.listings = []
+        
+        for block in blocks:
+            self.add_block(block)
+    
+    def add_block(self, block):
+        ''' Indexes top-level block appended to the page '''
+        self._add_part(block, ())
+    
+    def _add_part(self, part, parents):
+        if isinstance(part, Block):
+            if isinstance(part, CodeListing):
+                self.listings.append((part, parents))
+                return
+            
+            parents += (part, )
+            for child in part.parts:
+                self._add_part(child, parents)
+        elif isinstance(part, Reference):
+            self.references.append((part, parents))
+        elif isinstance(part, Link):
+            if part.type == Link.INTERNAL:
+                self.internal_links.append((part, parents))
+            elif part.type == Link.EXTERNAL:
+                self.external_links.append((part, parents))
+            
+            if isinstance(part, Image):
+                self.images.append((part, parents))
+    
+    @staticmethod
+    def get_list_level(parents, level=1):
+        ''' Returns level of innermost list entry containing part '''
+        for block in reversed(parents):
+            if isinstance(block, ListEntry):
+                return block.level
+        
+        return level
+
 def pprint_block(block, stream = sys.stdout, indent = 0):
     def do_print(s):
         print >> stream, ' ' * indent, s,
@@ -232,6 +363,18 @@ class Printer:
     xref_pages = True
     stream_mode = 'w'
     
+    # Printer supports incremental builds: pages which are not changed
+    # since previous build are not printed again (see tsdoc.depgraph)
+    incremental = False
+    
+    # Printer generates documents which may use search index written
+    # into search directory (see tsdoc.search)
+    search_index = False
+    
+    # Documents are served by web server, so compressed copies of them
+    # are written after all documents are generated (see tsdoc.compress)
+    precompress = False
+    
     TAB_STOPS = 4
     
     def _fix_tab_stops(self, text):
@@ -257,6 +400,25 @@ class Printer:
         
         return '\n'.join(lines)        
     
+    def prepare(self, doc_dir):
+        ''' Called before documents are generated into doc_dir '''
+        pass
+    
+    def get_build_key(self):
+        ''' Returns string with printer settings which affect all 
+        pages, so changing them will rebuild them '''
+        return ''
+    
+    def get_image_paths(self, where):
+        ''' Returns paths of files in image directory which are used 
+        to print image, so pages are printed again when they change '''
+        return [where]
+    
+    def get_asset_paths(self):
+        ''' Returns paths of files relative to documents directory which
+        were written by prepare() and are used by documents '''
+        return []
+    
     def do_print(self, stream, header, page):
         pass
     
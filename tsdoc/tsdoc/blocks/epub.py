@@ -3,6 +3,7 @@ import sys
 import datetime
 
 from tsdoc.blocks import *
+from tsdoc.images import ImageCatalog
 
 import zipfile
 from zipfile import ZipFile
@@ -93,7 +94,13 @@ class EpubPrinter(Printer):
                           ('DC', 'language', 'en')]
         
         self._items = []
-        self._images = set()
+        
+        # Content hash of image -> its path inside EPUB, so images
+        # with the same content are added once
+        self._images = {}
+        self._image_catalog = None
+        if self.IMAGE_PATH:
+            self._image_catalog = ImageCatalog.get_catalog(self.IMAGE_PATH)
         
     def do_print_pages(self, stream, header, pages):
         ''' Generates EPUB. EPUB is a zip file with bunch of XMLs/XHTMLs.
@@ -183,18 +190,17 @@ class EpubPrinter(Printer):
         
         self._docspaces = [docspace.docspace 
                            for docspace in index.docspaces]
-        self._find_page_info(blocks)
+        self._find_page_info(index, blocks)
         
-    def _find_page_info(self, parts, level=1):
-        for part in parts:
-            if isinstance(part, ListEntry):
-                level = part.level
-                
-            if isinstance(part, Block):
-                self._find_page_info(part.parts, level)
-                
-            if isinstance(part, Link) and part.type == Link.INTERNAL:
-                self._page_info[part.where] = (level, part.text)
+    def _find_page_info(self, index, blocks):
+        # Get levels and titles of pages from internal links in the
+        # given top-level blocks of index page
+        blocks = set(id(block) for block in blocks)
+        
+        for part, parents in index.get_part_index().internal_links:
+            if id(parents[0]) in blocks and part.type == Link.INTERNAL:
+                self._page_info[part.where] = (PartIndex.get_list_level(parents), 
+                                               part.text)
     
     def _add_toc_entry(self, page):
         ''' Adds TOC entry to toc01.html and toc.ncx. Both file has hierarchial organization,
@@ -528,15 +534,18 @@ class EpubPrinter(Printer):
     
     def _add_image(self, fname):
         ''' Adds image to EPUB-book and return its path to be used in src attribute '''
-        path = os.path.join('assets', fname)
+        image = self._image_catalog.get(fname)
         
-        if fname not in self._images:
-            stream = self._create_item('img', path, 'image/png')
+        path = self._images.get(image.hash)
+        if path is None:
+            path = os.path.join('assets', fname)
+            stream = self._create_item('img', path, image.mime_type)
             
-            img = open(os.path.join(self.IMAGE_PATH, fname))
-            stream.write(img.read())
+            # Image contents is read only to be embedded into book
+            with open(self._image_catalog.get_path(fname), 'rb') as img:
+                stream.write(img.read())
             
-            self._images.add(fname)
+            self._images[image.hash] = path
         
         return path
     
@@ -1,15 +1,25 @@
+import re
 import sys
+import functools
 import string
 import os
 
-from StringIO import StringIO
-
 from tsdoc.blocks import *
+from tsdoc.images import ImageCatalog
+from tsdoc.assets import AssetManifest
 
-import PIL
+def _compile_tag(tag, *attrs):
+    ''' Returns format string for opening tag with attributes which are 
+    substituted by name. Attributes are printed in the given order '''
+    return ''.join(['<%s' % tag] + 
+                   [' %s="%%(%s)s"' % (attr, attr) for attr in attrs] +
+                   ['>'])
 
 class HTMLPrinter(Printer):
     single_doc = False
+    incremental = True
+    search_index = True
+    precompress = os.environ.get('TSDOC_PRECOMPRESS') is not None
     
     NAV_HOME_TEXT = 'Home'
     
@@ -30,26 +40,90 @@ class HTMLPrinter(Printer):
     
     IMAGE_PATH = os.environ.get('TSDOC_IMGDIR')
     
+    # Copy images and files referred by template to names containing hash
+    # of their contents (see tsdoc.assets), so they may be cached forever
+    HASH_ASSETS = os.environ.get('TSDOC_HASH_ASSETS') is not None
+    
+    IMAGE_DIR = 'images'
+    TEMPLATE_ASSET_RE = re.compile(r'\$\{RELPATH\}([^"\'\s)]+)')
+    
     def __init__(self, template_path):
         template_file = file(template_path, 'r')
-        self.template = string.Template(template_file.read())
+        self.template_text = template_file.read()
+        self.template = string.Template(self.template_text)
         
         self._relpath = None
         self._image_scale = None
+        self._assets = None
+        
+        self._image_catalog = None
+        if self.IMAGE_PATH:
+            self._image_catalog = ImageCatalog.get_catalog(self.IMAGE_PATH)
+        
+        # Render handlers cached per class of block or part
+        self._block_handlers = {}
+        self._part_handlers = {}
+        
+        self._escape_text = functools.partial(self.TEXT_ESCAPE_RE.sub, 
+                                              self._escape_match)
         
         template_file.close()
     
+    def prepare(self, doc_dir):
+        if not self.HASH_ASSETS:
+            return
+        
+        self._assets = AssetManifest(doc_dir)
+        
+        if self._image_catalog is not None:
+            for where in sorted(self._image_catalog.images):
+                image = self._image_catalog.get(where)
+                self._assets.add('/'.join([self.IMAGE_DIR, where]),
+                                 self._image_catalog.get_path(where), image.hash)
+        
+        def add_template_asset(match):
+            name = match.group(1)
+            if os.path.isfile(os.path.join(doc_dir, name)):
+                name = self._assets.add(name)
+            
+            return '${RELPATH}' + name
+        
+        self.template = string.Template(
+                self.TEMPLATE_ASSET_RE.sub(add_template_asset, self.template_text))
+        
+        self._assets.save()
+    
+    def get_build_key(self):
+        return '%s\n%s' % (self.template.template, self.IMAGE_PATH)
+    
+    def get_asset_paths(self):
+        if self._assets is None:
+            return []
+        
+        return sorted(set(self._assets.assets.values()))
+    
+    def get_image_paths(self, where):
+        # Scaled copies are referred by srcset
+        image = self._get_image_info(where)
+        if image is None:
+            return [where]
+        
+        return [where] + image.scaled_paths
+    
     def do_print(self, stream, header, page):
-        self.real_stream = stream
         self.block_idx_gen = iter(xrange(sys.maxint))
-        self.stream = StringIO()
+        
+        # Page body is collected as a list of chunks which are joined once
+        self._chunks = []
         
         self._relpath = '../' if page.docspace else ''
         
         for block in page:
             self._print_block(block)
-            
-        body = self.stream.getvalue()
+        
+        body = ''.join(self._chunks)
+        self._chunks = None
+        
         navbar_top = self._gen_navbar(page, True)
         navbar_bottom = self._gen_navbar(page, False)
         
@@ -62,14 +136,12 @@ class HTMLPrinter(Printer):
                                         TAIL = '<!-- TAIL -->',
                                         RELPATH = self._relpath)
         
-        self.real_stream.write(text)
-        
-        self.stream.close()
+        stream.write(text)
     
     def _gen_navbar(self, page, brand_link):
         nav_home = ''
         nav_links = []
-                
+        
         if NavLink.HOME in page.nav_links:
             if brand_link:
                 nav_link = page.nav_links[NavLink.HOME]
@@ -96,170 +168,326 @@ class HTMLPrinter(Printer):
         
         return nav_home + '\n'.join(nav_links) 
     
+    # Escapes text: in code blocks raw HTML may be used, so only escaped 
+    # brackets are replaced (see _html_filter). Tabs outside tab stops
+    # are replaced with spaces everywhere
+    HTML_ESCAPES = {'<': '&lt;', '>': '&gt;',
+                    '\\<': '&lt;', '\\>': '&gt;',
+                    '\t': ' ' * Printer.TAB_STOPS}
+    
+    TEXT_ESCAPE_RE = re.compile(r'[<>\t]')
+    CODE_ESCAPE_RE = re.compile(r'\\[<>]|\t')
+    
+    @staticmethod
+    def _escape_match(match):
+        return HTMLPrinter.HTML_ESCAPES[match.group()]
+    
     def _html_filter(self, block, s):
         # FIXME: Allow to use raw HTML in Code (breaks compatibility with other printers!)
         if isinstance(block, Code):
-            s = self._fix_tab_stops(s)
+            if '\t' in s:
+                s = self._fix_tab_stops(s)
             
-            s = s.replace('\\<', '&lt;')
-            s = s.replace('\\>', '&gt;')
-        else:
-            s = s.replace('<', '&lt;')
-            s = s.replace('>', '&gt;')
+            return self.CODE_ESCAPE_RE.sub(self._escape_match, s)
+        
+        return self.TEXT_ESCAPE_RE.sub(self._escape_match, s)
+    
+    # Tags for blocks. Handlers return list of pairs of tag name and its 
+    # attributes or None if block shouldn't be printed. Handler for a block
+    # class is looked up once and cached: like in isinstance() chain, first 
+    # handler of a base class wins but paragraphs/headers are matched 
+    # separately, so code blocks are also wrapped into <p>
+    BLOCK_HANDLERS = [[(Paragraph, '_block_paragraph'),
+                       (Header, '_block_header')],
+                      [(CodeListing, '_block_code_listing'),
+                       (Code, '_block_code'),
+                       (ListEntry, '_block_list_entry'),
+                       (ListBlock, '_block_list'),
+                       (Table, '_block_table'),
+                       (TableRow, '_block_table_row'),
+                       (TableCell, '_block_table_cell'),
+                       (BlockQuote, '_block_quote'),
+                       (FlowableIncut, '_block_flowable_incut'),
+                       (PageSpacer, '_block_page_spacer'),
+                       (Incut, '_block_incut'),
+                       (Span, '_block_span')]]
+    
+    def _get_block_handlers(self, cls):
+        handlers = self._block_handlers.get(cls)
+        if handlers is None:
+            handlers = []
+            for group in HTMLPrinter.BLOCK_HANDLERS:
+                for base, name in group:
+                    if issubclass(cls, base):
+                        handlers.append(getattr(self, name))
+                        break
+            
+            self._block_handlers[cls] = handlers
+        
+        return handlers
+    
+    def _block_paragraph(self, block, codeid):
+        return [('p', None)]
+    
+    def _block_header(self, block, codeid):
+        return [('h%d' % block.size, None)]
+    
+    def _block_code_listing(self, block, codeid):
+        if not codeid:
+            return [('div', 'class="well"')]
+        
+        return self._block_code(block, codeid)
+    
+    def _block_code(self, block, codeid):
+        return [('pre', None if not codeid 
+                         else 'id="code%d" class="hide"' % codeid)]
+    
+    def _block_list_entry(self, block, codeid):
+        return [('li', None)]
+    
+    def _block_list(self, block, codeid):
+        return [('ul', None)]
+    
+    def _block_table(self, block, codeid):
+        attr = 'class="table table-bordered"'
+        if block.colwidths is not None:
+            # Do not make width of every column strict
+            attr += ' style="width: %d%%"' % int(100 * sum(block.colwidths))
+        
+        return [('table', attr)]
+    
+    def _block_table_row(self, block, codeid):
+        return [('tr', None)]
+    
+    def _block_table_cell(self, block, codeid):
+        attrs = ''
+        if block.colspan > 1:
+            attrs += ' colspan="%d"' % block.colspan
+        if block.rowspan > 1:
+            attrs += ' rowspan="%d"' % block.rowspan
+        
+        return [('td', attrs)]
+    
+    def _block_quote(self, block, codeid):
+        return [('blockquote', None)]
+    
+    def _block_flowable_incut(self, block, codeid):
+        style = 'position: absolute; '
+        if 'x' in block.coords:
+            x = block.coords['x'] * self.FLOATING_DIV_BASE_PCT
+            style += 'left: {0:.1f}%; '.format(x)
+        if 'w' in block.coords:
+            w = block.coords['w'] * self.FLOATING_DIV_BASE_WIDTH
+            style += 'width: {0:.1f}px; '.format(w)
+        if 'y' in block.coords:
+            y = block.coords['y'] * self.SPACER_BASE_HEIGHT
+            style += 'margin-top: {0:.1f}px; '.format(y)
+        if 's' in block.coords:
+            self._image_scale = block.coords['s']
         
+        return [('div', 'style="{0}"'.format(style))]
+    
+    def _block_page_spacer(self, block, codeid):
+        if block.iscond:
+            return None
+        
+        h = block.height * self.SPACER_BASE_HEIGHT
+        return [('div', 'style="height: {0:.1f}px"'.format(h))]
+    
+    def _block_incut(self, block, codeid):
+        _class, label = HTMLPrinter.INCUT_CLASSES[block.style]
+        self._chunks.append('<span class="%s">%s</span>' % (_class, label))
         
-        return s
+        return [('div', 'class="well"')]
+    
+    def _block_span(self, block, codeid):
+        if block.style == 'small':
+            return [('small', None)]
+        elif block.style[0] == '#':
+            return [('span', 'style="color: {0};"'.format(block.style[1:]))]
+        
+        return []
     
     def _print_block(self, block, indent = 0, codeid = None):
-        block_tags = [] 
-        in_code = False
+        write = self._chunks.append
         
-        if isinstance(block, Paragraph):
-            block_tags.append(('p', None))
-        elif isinstance(block, Header):
-            block_tags.append(('h%d' % block.size, None))
-        if not codeid and isinstance(block, CodeListing):
-            block_tags.append(('div', 'class="well"'))
-        elif isinstance(block, Code):
-            block_tags.append(('pre', None if not codeid 
-                                      else 'id="code%d" class="hide"' % codeid))
-            in_code = True
-        elif isinstance(block, ListEntry):
-            block_tags.append(('li', None))
-        elif isinstance(block, ListBlock):
-            block_tags.append(('ul', None))
-        elif isinstance(block, Table):
-            attr = 'class="table table-bordered"'
-            if block.colwidths is not None:
-                # Do not make width of every column strict
-                attr += ' style="width: %d%%"' % int(100 * sum(block.colwidths))
-            
-            block_tags.append(('table', attr))
-        elif isinstance(block, TableRow):
-            block_tags.append(('tr', None))
-        elif isinstance(block, TableCell):
-            attrs = ''
-            if block.colspan > 1:
-                attrs += ' colspan="%d"' % block.colspan
-            if block.rowspan > 1:
-                attrs += ' rowspan="%d"' % block.rowspan
-            
-            block_tags.append(('td', attrs))
-        elif isinstance(block, BlockQuote):
-            block_tags.append(('blockquote', None))
-        elif isinstance(block, FlowableIncut):
-            style = 'position: absolute; '
-            if 'x' in block.coords:
-                x = block.coords['x'] * self.FLOATING_DIV_BASE_PCT
-                style += 'left: {0:.1f}%; '.format(x)
-            if 'w' in block.coords:
-                w = block.coords['w'] * self.FLOATING_DIV_BASE_WIDTH
-                style += 'width: {0:.1f}px; '.format(w)
-            if 'y' in block.coords:
-                y = block.coords['y'] * self.SPACER_BASE_HEIGHT
-                style += 'margin-top: {0:.1f}px; '.format(y)
-            if 's' in block.coords:
-                self._image_scale = block.coords['s']
-            
-            block_tags.append(('div', 'style="{0}"'.format(style)))
-        elif isinstance(block, PageSpacer):
-            if block.iscond:
+        handlers = self._block_handlers.get(block.__class__)
+        if handlers is None:
+            handlers = self._get_block_handlers(block.__class__)
+        
+        # Opening and closing tags are written as single chunks
+        opening = []
+        closing = []
+        for handler in handlers:
+            tags = handler(block, codeid)
+            if tags is None:
                 return
-            h = block.height * self.SPACER_BASE_HEIGHT
-            block_tags.append(('div', 'style="height: {0:.1f}px"'.format(h)))
-        elif isinstance(block, Incut):
-            block_tags.append(('div', 'class="well"'))
             
-            _class, label = HTMLPrinter.INCUT_CLASSES[block.style]
-            self.stream.write('<span class="%s">%s</span>' % (_class, label))
-        elif isinstance(block, Span):
-            if block.style == 'small':
-                block_tags.append(('small', None))
-            elif block.style[0] == '#':
-                block_tags.append(('span', 'style="color: {0};"'.format(block.style[1:])))
-        
-        for tag, attrs in block_tags:
-            self.stream.write(' ' * indent)
-            if attrs:
-                self.stream.write('<%s %s>\n' % (tag, attrs))
-            else:
-                self.stream.write('<%s>\n' % (tag))
+            for tag, attrs in tags:
+                if attrs:
+                    opening.append('%s<%s %s>\n' % (' ' * indent, tag, attrs))
+                else:
+                    opening.append('%s<%s>\n' % (' ' * indent, tag))
+                closing.append('</%s>\n' % tag)
+        
+        write(''.join(opening))
         
         if not codeid and isinstance(block, CodeListing):
             # Embedded codelisting
             fname = os.path.basename(block.fname)
             blockid = next(self.block_idx_gen) + 1
-            self.stream.write('<button class="btn" onclick="toggleCode(\'code%s\')">+</button>' % (blockid))
-            self.stream.write('&nbsp; Script file %s <br/>' % (fname))
+            write('<button class="btn" onclick="toggleCode(\'code%s\')">+</button>' % (blockid))
+            write('&nbsp; Script file %s <br/>' % (fname))
             self._print_block(block, codeid = blockid)
         else:
             self._print_parts(block, indent)
         
-        for (tag, attrs) in reversed(block_tags):
-            self.stream.write('</%s>\n' % tag)
+        closing.reverse()
+        write(''.join(closing))
         
         if isinstance(block, FlowableIncut) and 's' in block.coords:
             self._image_scale = None
+    
+    # Handlers of block parts return HTML for the part given its escaped
+    # text. Like with blocks, handler is looked up once per class. Nested
+    # blocks are printed by _print_parts() directly because they have no text
+    PART_HANDLERS = [(ItalicText, '_part_italic'),
+                     (BoldText, '_part_bold'),
+                     (InlineCode, '_part_inline_code'),
+                     (Label, '_part_label'),
+                     (Reference, '_part_reference'),
+                     (Image, '_part_image'),
+                     (Link, '_part_link'),
+                     (BreakLine, '_part_break_line')]
+    
+    LABEL_TAG = _compile_tag('span', 'class')
+    REFERENCE_TAG = _compile_tag('a', 'name')
+    IMAGE_TAG = _compile_tag('img', 'src', 'alt', 'class', 'loading')
+    SIZED_IMAGE_TAG = _compile_tag('img', 'src', 'width', 'height', 
+                                   'alt', 'class', 'loading')
+    RESPONSIVE_IMAGE_TAG = _compile_tag('img', 'src', 'srcset', 'sizes', 
+                                        'width', 'height', 
+                                        'alt', 'class', 'loading')
+    LINK_TAG = _compile_tag('a', 'href')
+    INVALID_LINK_TAG = _compile_tag('a', 'href', 'style')
+    
+    def _get_part_handler(self, cls):
+        handler = self._part_handlers.get(cls)
+        if handler is None:
+            handler = self._part_text
+            for base, name in HTMLPrinter.PART_HANDLERS:
+                if issubclass(cls, base):
+                    handler = getattr(self, name)
+                    break
+            
+            self._part_handlers[cls] = handler
+        
+        return handler
+    
+    def _part_text(self, part, text, indent):
+        return text
+    
+    def _part_italic(self, part, text, indent):
+        return '<em>' + text + '</em>'
+    
+    def _part_bold(self, part, text, indent):
+        return '<strong>' + text + '</strong>'
+    
+    def _part_inline_code(self, part, text, indent):
+        return '<code>' + text + '</code>'
+    
+    def _part_label(self, part, text, indent):
+        return (self.LABEL_TAG % {'class': 'label label-%s' % part.style} + 
+                text + '</span>')
+    
+    def _part_reference(self, part, text, indent):
+        return self.REFERENCE_TAG % {'name': part.get_name()} + '</a>'
+    
+    def _get_image_src(self, where):
+        # XXX: very dependent on book's directory structure
+        src = self.IMAGE_DIR + '/' + where
+        if self._assets is not None:
+            src = self._assets.get(src)
+        
+        return self._relpath + src
+    
+    def _get_image_info(self, where):
+        # Images missing from catalog are reported by IndexPage.check(), 
+        # so they are printed without dimensions
+        if self._image_catalog is None:
+            return None
+        
+        try:
+            return self._image_catalog.get(where)
+        except OSError:
+            return None
+    
+    def _part_image(self, part, text, indent):
+        attrs = {'src': self._get_image_src(part.where),
+                 'alt': text,
+                 'class': 'img-rounded',
+                 'loading': 'lazy'}
+        
+        # Intrinsic dimensions let browser reserve space for image before
+        # it is loaded
+        image = self._get_image_info(part.where)
+        if image is None:
+            return self.IMAGE_TAG % attrs + '</img>'
+        
+        scale = self._image_scale or 1.0
+        width = int(round(image.width * scale))
+        attrs['width'] = width
+        attrs['height'] = int(round(image.height * scale))
+        
+        if not image.scaled_paths:
+            return self.SIZED_IMAGE_TAG % attrs + '</img>'
         
+        # Let browser choose copy of image rendered with width closest 
+        # to the width image is displayed with
+        candidates = [(image.width, part.where)]
+        for where in image.scaled_paths:
+            candidates.append((self._image_catalog.get(where).width, where))
+        
+        attrs['srcset'] = ', '.join('%s %dw' % (self._get_image_src(where), 
+                                                 candidate_width)
+                                    for candidate_width, where in sorted(candidates))
+        attrs['sizes'] = '(max-width: {0}px) 100vw, {0}px'.format(width)
+        
+        return self.RESPONSIVE_IMAGE_TAG % attrs + '</img>'
+    
+    def _part_link(self, part, text, indent):
+        if part.type == Link.INVALID:
+            return self.INVALID_LINK_TAG % {'href': part.where, 
+                                            'style': 'color: red'} + text + '</a>'
+        
+        return self.LINK_TAG % {'href': part.where} + text + '</a>'
+    
+    def _part_break_line(self, part, text, indent):
+        return '<br />'
+    
     def _print_parts(self, block, indent):
-        text = ''
-        list_stack = []
+        write = self._chunks.append
+        
+        if isinstance(block, Code):
+            escape = lambda s: self._html_filter(block, s)
+        else:
+            escape = self._escape_text
+        
+        handlers = self._part_handlers
         for part in block:
+            if part.__class__ is str:
+                # Plain text is the most common part
+                write(escape(part))
+                continue
+            
             if isinstance(part, Block):
                 self._print_block(part, indent + 4)
-            else:
-                tag = None
-                tag_attrs = {}
-                text = self._html_filter(block, str(part))
-                
-                if isinstance(part, ItalicText):
-                    tag = 'em'
-                elif isinstance(part, BoldText):
-                    tag = 'strong'
-                elif isinstance(part, InlineCode):                    
-                    tag = 'code'
-                elif isinstance(part, Label):                    
-                    tag = 'span'
-                    tag_attrs["class"] = "label label-%s" % part.style
-                elif isinstance(part, Reference):
-                    tag = 'a'
-                    tag_attrs['name'] = part.get_name()
-                    text = ''
-                elif isinstance(part, Image):
-                    # XXX: very dependent on book's directory structure
-
-                    tag = 'img'
-                    tag_attrs['src'] = self._relpath + 'images/' + part.where
-                    tag_attrs['alt'] = text
-                    tag_attrs['class'] = 'img-rounded'
-                    if self._image_scale:
-                        image = PIL.Image.open(os.path.join(self.IMAGE_PATH, part.where))
-                        imgwidth, imgheight = image.size
-                        tag_attrs['width'] = imgwidth * self._image_scale
-                        tag_attrs['height'] = imgheight * self._image_scale
-                    
-                    text = ''
-                elif isinstance(part, Link):
-                    tag = 'a'
-                    tag_attrs['href'] = part.where
-                    
-                    if part.type == Link.INVALID:
-                        tag_attrs['style'] = "color: red"
-                elif isinstance(part, BreakLine):
-                    self.stream.write('<br />')
-                    continue
-                
-                if tag:
-                    attr_str = ' '.join('%s="%s"' % (attr, value)
-                                        for attr, value
-                                        in tag_attrs.items())
-                    if attr_str:
-                        attr_str = ' ' + attr_str
-                    
-                    text = '<%s%s>' % (tag, attr_str) + text + '</%s>' % (tag)                
-                
-                text = text.replace('\t', ' ' * Printer.TAB_STOPS)
-                
-                # if not in_code:
-                #    self.stream.write('\n' + ' ' * indent)
-                self.stream.write(text)
\ No newline at end of file
+                continue
+            
+            handler = handlers.get(part.__class__)
+            if handler is None:
+                handler = self._get_part_handler(part.__class__)
+            
+            text = handler(part, escape(str(part)), indent)
+            if text:
+                write(text)
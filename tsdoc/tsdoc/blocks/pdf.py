@@ -7,12 +7,11 @@ import string
 import itertools
 import cStringIO
 
-import PIL
-
 from tempfile import NamedTemporaryFile
 from PyPDF2 import PdfFileWriter, PdfFileReader, PdfFileMerger
 
 from tsdoc.blocks import *
+from tsdoc.images import ImageCatalog
 
 from reportlab.rl_config import defaultPageSize
 from reportlab.platypus import (BaseDocTemplate, PageTemplate, NextPageTemplate,
@@ -348,6 +347,9 @@ class PDFPrinter(Printer):
         self._page_info = {}
         self._current_page = None
         self._pdf_images = []
+        self._image_catalog = None
+        if self.IMAGE_PATH:
+            self._image_catalog = ImageCatalog.get_catalog(self.IMAGE_PATH)
         
         self._story = []
         self._story_stack = []
@@ -575,7 +577,7 @@ class PDFPrinter(Printer):
             
             self._print_paragraph(block, root=True)
             
-        self._find_page_info(blocks)
+        self._find_page_info(index, blocks)
         
         # Print table of contents. index.md contains 
         story.append(PageBreak())
@@ -615,16 +617,15 @@ class PDFPrinter(Printer):
         
         self._story.append(toc)
     
-    def _find_page_info(self, parts, level=1):
-        for part in parts:
-            if isinstance(part, ListEntry):
-                level = part.level
-                
-            if isinstance(part, Block):
-                self._find_page_info(part.parts, level)
-                
-            if isinstance(part, Link) and part.type == Link.INTERNAL:
-                self._page_info[part.where] = (level, part.text)
+    def _find_page_info(self, index, blocks):
+        # Get levels and titles of pages from internal links in the
+        # given top-level blocks of index page
+        blocks = set(id(block) for block in blocks)
+        
+        for part, parents in index.get_part_index().internal_links:
+            if id(parents[0]) in blocks and part.type == Link.INTERNAL:
+                self._page_info[part.where] = (PartIndex.get_list_level(parents), 
+                                               part.text)
     
     def _save_state(self):        
         self._story_stack.append(self._story)
@@ -729,9 +730,8 @@ class PDFPrinter(Printer):
         path = os.path.join(self.IMAGE_PATH, img.where)
         
         # We need to perform proportional resizing of images if they exceed 
-        # page size and also apply dpi to them. So pre-read images.
-        
-        image = PIL.Image.open(path)
+        # page size and also apply dpi to them. Sizes are taken from catalog.
+        image = self._image_catalog.get(img.where)
         
         maxwidth, maxheight = self._get_page_width() * width, self.PAGE_HEIGHT
         imgwidth, imgheight = image.size
@@ -748,8 +748,8 @@ class PDFPrinter(Printer):
         
         if imgwidth > self.MAX_INLINE_IMAGE_SIZE or imgheight > self.MAX_INLINE_IMAGE_SIZE:
             # Try to use pdf images for large images so it will be vectorized
-            pdfpath = path.replace('.png', '.pdf')
-            if os.path.exists(pdfpath):
+            if image.pdf_path is not None:
+                pdfpath = self._image_catalog.get_path(image.pdf_path)
                 pdfimg = _PDFImage(pdfpath, imgwidth, imgheight)
                 self._pdf_images.append(pdfimg)
                 return pdfimg
@@ -0,0 +1,79 @@
+'''
+TSDoc book bundle
+
+Keeps parsed and indexed book on disk, so builds of other formats from the
+same sources do not have to parse pages and process index again. Bundle is
+an IndexPage object pickled right after it was created, so it contains all
+pages, docspaces with their links, references and book index.
+
+Bundle is valid only for exact set of page texts and header it was created
+for and also for the same code of parser and pages, so it is addressed by a
+key which is hash of all of them.
+
+Listing files and images are not part of the key: code listings are pickled
+without their text and load it on first access, and images are referred by
+path. Pages using changed listings or images are printed again because of
+dependency graph (see tsdoc.depgraph).
+'''
+
+import os
+import sys
+import hashlib
+
+import cPickle as pickle
+
+import tsdoc.page
+import tsdoc.blocks
+import tsdoc.mdparser2
+
+class BookBundle(object):
+    VERSION = 1
+    
+    # Modules which define classes of objects kept in bundle
+    MODULES = [tsdoc.page, tsdoc.blocks, tsdoc.mdparser2]
+    
+    def __init__(self, path):
+        self.path = path
+    
+    @staticmethod
+    def get_key(index_path, page_paths, doc_header):
+        digest = hashlib.sha1(str(BookBundle.VERSION))
+        digest.update(doc_header)
+        
+        for module in BookBundle.MODULES:
+            with open(module.__file__.replace('.pyc', '.py')) as f:
+                digest.update(f.read())
+        
+        for path in [index_path] + sorted(page_paths):
+            with open(path) as f:
+                digest.update(path)
+                digest.update(f.read())
+        
+        return digest.hexdigest()
+    
+    def load(self, key):
+        ''' Returns IndexPage stored in bundle or None if there is
+        no bundle or it was created for another key '''
+        try:
+            with open(self.path, 'rb') as f:
+                if pickle.load(f) != key:
+                    return None
+                
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+    
+    def store(self, key, index_page):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        
+        # Block trees are nested deeply
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+        
+        tmp_path = '%s.%d' % (self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(index_page, f, pickle.HIGHEST_PROTOCOL)
+        
+        os.rename(tmp_path, self.path)
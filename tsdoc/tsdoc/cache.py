@@ -0,0 +1,55 @@
+'''
+TSDoc parse cache
+
+Keeps parsed block trees of markdown pages on disk, so unchanged pages
+are not re-parsed by subsequent builds. Entries are addressed by hash of
+page text and parser version. Code listings in cached trees refer to their
+files by name and load them on first access, so entries do not depend on
+contents of listing files.
+'''
+
+import os
+import hashlib
+
+import cPickle as pickle
+
+from tsdoc.mdparser2 import MarkdownParser
+
+class ParseCache(object):
+    SUFFIX = '.pickle'
+    
+    # Version of entry format
+    VERSION = 2
+    
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+    
+    def _get_path(self, text):
+        digest = hashlib.sha1(text)
+        digest.update(str(MarkdownParser.VERSION))
+        digest.update(str(ParseCache.VERSION))
+        
+        return os.path.join(self.cache_dir, digest.hexdigest() + self.SUFFIX)
+    
+    def load(self, text):
+        ''' Returns list of blocks parsed from text or None if
+        there is no entry for it '''
+        try:
+            with open(self._get_path(text), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+    
+    def store(self, text, blocks):
+        # Write entry to temporary file first so concurrent builds
+        # will never see partially written entry
+        path = self._get_path(text)
+        tmp_path = '%s.%d' % (path, os.getpid())
+        
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(blocks, f, pickle.HIGHEST_PROTOCOL)
+        
+        os.rename(tmp_path, path)
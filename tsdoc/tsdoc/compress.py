@@ -0,0 +1,144 @@
+'''
+TSDoc precompressed documents
+
+Writes compressed copies of documents next to them, i.e. intro/dtrace.html.gz
+and intro/dtrace.html.br for intro/dtrace.html, so web server may send them
+as is (nginx gzip_static and brotli_static) instead of compressing documents
+on every request.
+
+Compressed copies are created for HTML pages, stylesheets, scripts and plain
+SVG images written by the build. Other files in the documents directory are
+left alone: it may also contain sources such as the page template. Hashes
+of compressed files are kept in '.precompressed.json' in the documents
+directory, so files which were not changed since previous build are not
+compressed again. Brotli copies are created only if brotli module is
+installed.
+'''
+
+import os
+import gzip
+import json
+import hashlib
+import multiprocessing
+
+from StringIO import StringIO
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def _write_file(path, data):
+    tmp_path = '%s.%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    
+    os.rename(tmp_path, path)
+
+def _compress_file(path):
+    ''' Writes compressed copies of file. Called in worker processes,
+    so it is not a method of Precompressor '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    
+    # Zero modification time makes copies of the same file identical
+    stream = StringIO()
+    with gzip.GzipFile(fileobj=stream, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    
+    _write_file(path + '.gz', stream.getvalue())
+    
+    if brotli is not None:
+        _write_file(path + '.br', brotli.compress(data, quality=11))
+
+class Precompressor(object):
+    MANIFEST_NAME = '.precompressed.json'
+    
+    EXTENSIONS = ('.html', '.css', '.js', '.plain.svg')
+    SUFFIXES = ('.gz', '.br')
+    
+    def __init__(self, doc_dir, jobs=None):
+        self.doc_dir = doc_dir
+        self.jobs = jobs
+        
+        self.path = os.path.join(doc_dir, self.MANIFEST_NAME)
+        
+        # Path relative to doc_dir -> [mtime, size, sha1 of contents]
+        self.files = {}
+        try:
+            with open(self.path) as f:
+                self.files = json.load(f)
+        except (IOError, ValueError):
+            pass
+    
+    def _is_compressed(self, path):
+        suffixes = self.SUFFIXES if brotli is not None else self.SUFFIXES[:1]
+        return all(os.path.exists(path + suffix) for suffix in suffixes)
+    
+    def _check_file(self, name, record):
+        ''' Returns new record for file and flag if file should be
+        compressed. File is read only if its stat is changed '''
+        path = os.path.join(self.doc_dir, name)
+        
+        st = os.stat(path)
+        stat = [st.st_mtime, st.st_size]
+        
+        if record is not None and record[:2] == stat and self._is_compressed(path):
+            return record, False
+        
+        with open(path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        
+        if record is not None and record[2] == digest and self._is_compressed(path):
+            return stat + [digest], False
+        
+        return stat + [digest], True
+    
+    def _remove_stale(self, name):
+        path = os.path.join(self.doc_dir, name)
+        for suffix in self.SUFFIXES:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    
+    def run(self, names):
+        ''' Compresses new and changed files from the list of files written
+        by the build. Names are relative to documents directory. Copies of
+        files which are not in the list anymore are removed. Returns number
+        of compressed files '''
+        files = {}
+        changed = []
+        
+        for name in sorted(set(names)):
+            if not name.endswith(self.EXTENSIONS):
+                continue
+            
+            record, is_changed = self._check_file(name, self.files.get(name))
+            if is_changed:
+                changed.append(name)
+            
+            files[name] = record
+        
+        for name in set(self.files) - set(files):
+            self._remove_stale(name)
+        
+        paths = [os.path.join(self.doc_dir, name) for name in sorted(changed)]
+        if self.jobs == 1 or len(paths) < 2:
+            map(_compress_file, paths)
+        else:
+            pool = multiprocessing.Pool(self.jobs)
+            try:
+                pool.map(_compress_file, paths)
+            finally:
+                pool.close()
+                pool.join()
+        
+        if files != self.files:
+            self.files = files
+            
+            tmp_path = '%s.%d' % (self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(files, f, indent=1, sort_keys=True)
+            
+            os.rename(tmp_path, self.path)
+        
+        return len(paths)
@@ -0,0 +1,171 @@
+'''
+TSDoc page dependency graph
+
+Allows incremental builds for printers which generate a file per page.
+After each build a graph is saved which records for every generated page:
+    - digest of page contents after links were resolved, so it changes when
+      page text, target of any link or text of a link is changed
+    - pages referred by links in the page
+    - pages referred by navigation links and their headers
+    - listings and images used by the page with their modification times
+      and sizes, images may be printed using several files (see 
+      Printer.get_image_paths())
+On the next build page is generated again only if its record differs
+from the saved one or output file is missing. Records are also bound to
+printer code and its settings (like HTML template), so changing them
+rebuilds all pages.
+'''
+
+import os
+import json
+import inspect
+import hashlib
+
+from tsdoc.blocks import *
+from tsdoc.listing import ListingStore
+
+class DependencyGraph(object):
+    def __init__(self, path, printer):
+        self.path = path
+        self.key = self._get_build_key(printer)
+        self.printer = printer
+        
+        self.image_dir = os.environ.get('TSDOC_IMGDIR', '')
+        
+        self.old_pages = {}
+        self.pages = {}
+        
+        self.skipped = 0
+        
+        self._load()
+    
+    @staticmethod
+    def _get_build_key(printer):
+        digest = hashlib.sha1(printer.__class__.__name__)
+        digest.update(printer.get_build_key())
+        
+        # Modules where printer class and its base classes are defined
+        paths = []
+        for cls in inspect.getmro(printer.__class__):
+            try:
+                path = inspect.getsourcefile(cls)
+            except TypeError:
+                # Built-in class
+                continue
+            
+            if path not in paths:
+                paths.append(path)
+        
+        for path in paths:
+            with open(path) as f:
+                digest.update(f.read())
+        
+        return digest.hexdigest()
+    
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                graph = json.load(f)
+        except (IOError, ValueError):
+            return
+        
+        if graph.get('key') == self.key:
+            self.old_pages = graph['pages']
+    
+    def save(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        
+        tmp_path = '%s.%d' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': self.key, 'pages': self.pages}, f,
+                      indent=1, sort_keys=True)
+        
+        os.rename(tmp_path, self.path)
+    
+    @staticmethod
+    def _stat_file(path):
+        try:
+            return list(ListingStore.stat_file(path))
+        except OSError:
+            return None
+    
+    def collect(self, page, header):
+        ''' Creates dependency record for the page which is going to
+        be printed with the header '''
+        listings = []
+        images = []
+        
+        digest = hashlib.sha1()
+        for block in page.blocks:
+            self._digest_part(digest, block, listings, images)
+        
+        nav = [[nav_type, nav_link.page.page_path, nav_link.where, nav_link.page.header]
+               for nav_type, nav_link in sorted(page.nav_links.items())]
+        
+        record = {'content': digest.hexdigest(),
+                  'header': header,
+                  'links': sorted(page.link_targets),
+                  'nav': nav,
+                  'listings': [[fname, self._stat_file(fname)]
+                               for fname in sorted(set(listings))],
+                  'images': [[path, self._stat_file(os.path.join(self.image_dir, path))]
+                             for path in self._get_image_paths(images)]}
+        
+        # Convert strings to unicode like they would be after loading
+        # graph, so records may be compared directly
+        return json.loads(json.dumps(record))
+    
+    def _get_image_paths(self, images):
+        paths = set()
+        for where in images:
+            paths.update(self.printer.get_image_paths(where))
+        
+        return sorted(paths)
+    
+    def _digest_part(self, digest, part, listings, images):
+        if isinstance(part, Block):
+            digest.update(part.__class__.__name__)
+            for cls in part.__class__.__mro__:
+                for attr in getattr(cls, '__slots__', ()):
+                    if attr not in ('parts', '_parts', '_loaded_parts'):
+                        digest.update(repr(getattr(part, attr)))
+            
+            if isinstance(part, CodeListing) and part.fname:
+                # Listing text is not read, it is tracked by modification time
+                listings.append(part.fname)
+                return
+            
+            digest.update('(')
+            for child in part.parts:
+                self._digest_part(digest, child, listings, images)
+            digest.update(')')
+        else:
+            if isinstance(part, Image):
+                images.append(part.where)
+            
+            digest.update(repr(part))
+    
+    def is_dirty(self, page, record):
+        ''' Returns True if page has to be printed. Remembers record
+        for the page, so it will be saved into the graph '''
+        self.pages[page.doc_path] = record
+        
+        if self.old_pages.get(page.doc_path) != record or \
+                not os.path.exists(page.doc_path):
+            return True
+        
+        self.skipped += 1
+        return False
+    
+    def get_changes(self, page):
+        ''' Returns names of record fields which were changed since
+        previous build or None if page wasn't built before '''
+        old_record = self.old_pages.get(page.doc_path)
+        if old_record is None:
+            return None
+        
+        record = self.pages[page.doc_path]
+        return [field for field in sorted(record)
+                if record[field] != old_record.get(field)]
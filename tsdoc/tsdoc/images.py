@@ -0,0 +1,228 @@
+'''
+TSDoc image catalog
+
+Keeps metadata of images from the image directory (TSDOC_IMGDIR), so
+printers do not open image files while rendering pages. For every image
+catalog records its dimensions, format, content hash, vector variants
+built from the same SVG (.pdf and .plain.svg files) and PNG copies rendered
+with other widths for HTML srcset (i.e. dtrace.400w.png for dtrace.png).
+
+Catalog is refreshed once per build: files are stat()-ed and only new or
+changed images are read. If TSDOC_IMAGE_CATALOG is set, catalog is saved
+into that file, so the next build will reuse metadata of unchanged images.
+'''
+
+import os
+import re
+import json
+import hashlib
+
+import PIL.Image
+
+from tsdoc.assets import AssetManifest
+
+CATALOG_PATH = os.getenv('TSDOC_IMAGE_CATALOG', None)
+
+def _encode_strings(obj):
+    ''' Converts unicode strings loaded from JSON to byte strings
+    which are used by pages and printers '''
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    elif isinstance(obj, list):
+        return [_encode_strings(item) for item in obj]
+    elif isinstance(obj, dict):
+        return dict((_encode_strings(key), _encode_strings(value))
+                    for key, value in obj.iteritems())
+    
+    return obj
+
+class ImageInfo(object):
+    __slots__ = ('where', 'width', 'height', 'format', 'hash',
+                 'pdf_path', 'svg_path', 'scaled_paths')
+    
+    MIME_TYPES = {'PNG': 'image/png',
+                  'JPEG': 'image/jpeg',
+                  'GIF': 'image/gif'}
+    
+    def __init__(self, where, record):
+        self.where = where
+        
+        self.width, self.height = record['size']
+        self.format = record['format']
+        self.hash = record['hash']
+        self.pdf_path = record['pdf']
+        self.svg_path = record['svg']
+        self.scaled_paths = record['scaled']
+    
+    @property
+    def size(self):
+        return self.width, self.height
+    
+    @property
+    def mime_type(self):
+        return self.MIME_TYPES.get(self.format, 'application/octet-stream')
+
+class ImageCatalog(object):
+    VERSION = 2
+    
+    EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+    
+    # Intermediate files of images/SConscript
+    IGNORE_SUFFIXES = ('.svg.png', )
+    
+    # Vector variants of images built from the same SVG
+    VARIANTS = [('pdf', '.pdf'), ('svg', '.plain.svg')]
+    
+    # Copies of image rendered with specific width, i.e. dtrace.400w.png
+    SCALED_NAME_RE = re.compile(r'^(.*)\.(\d+)w\.png$')
+    
+    _catalogs = {}
+    
+    @staticmethod
+    def get_catalog(image_dir):
+        ''' Returns catalog for image directory. Catalog is created and
+        refreshed on first call, so it is shared by all printers of
+        the build '''
+        catalog = ImageCatalog._catalogs.get(image_dir)
+        if catalog is None:
+            catalog = ImageCatalog(image_dir, CATALOG_PATH)
+            catalog.refresh()
+            
+            ImageCatalog._catalogs[image_dir] = catalog
+        
+        return catalog
+    
+    def __init__(self, image_dir, path=None):
+        self.image_dir = image_dir
+        self.path = path
+        
+        self.images = {}
+        self._load()
+    
+    def _load(self):
+        if not self.path:
+            return
+        
+        try:
+            with open(self.path) as f:
+                catalog = json.load(f)
+        except (IOError, ValueError):
+            return
+        
+        if catalog.get('version') == self.VERSION and \
+                catalog.get('image_dir') == self.image_dir:
+            self.images = _encode_strings(catalog['images'])
+    
+    def save(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        
+        tmp_path = '%s.%d' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': self.VERSION,
+                       'image_dir': self.image_dir,
+                       'images': self.images}, f, indent=1, sort_keys=True)
+        
+        os.rename(tmp_path, self.path)
+    
+    def refresh(self):
+        ''' Walks image directory and reads images which were added or
+        changed since catalog was saved. Saves catalog if it was changed '''
+        images = {}
+        changed = False
+        
+        # HTMLPrinter keeps hashed copies of images in the images directory
+        # of documents, so if it is the image directory, copies are listed
+        # in manifest of its parent directory
+        image_dir = os.path.normpath(os.path.abspath(self.image_dir))
+        assets = AssetManifest(os.path.dirname(image_dir))
+        assets_prefix = os.path.basename(image_dir)
+        
+        for dirpath, _, fnames in os.walk(self.image_dir):
+            reldir = os.path.relpath(dirpath, self.image_dir)
+            fnames = set(fnames)
+            
+            for fname in fnames:
+                if not fname.endswith(self.EXTENSIONS) or \
+                        fname.endswith(self.IGNORE_SUFFIXES):
+                    continue
+                
+                where = os.path.normpath(os.path.join(reldir, fname))
+                
+                # Copies created by HTMLPrinter when assets are hashed
+                if assets.is_hashed_name('/'.join([assets_prefix, where])):
+                    continue
+                
+                record = self._refresh_image(where, self.images.get(where))
+                self._find_variants(where, record, fnames)
+                
+                if record != self.images.get(where):
+                    changed = True
+                
+                images[where] = record
+        
+        if set(images) != set(self.images):
+            changed = True
+        
+        self.images = images
+        
+        if changed and self.path:
+            self.save()
+    
+    def _refresh_image(self, where, record):
+        path = os.path.join(self.image_dir, where)
+        
+        st = os.stat(path)
+        stat = [st.st_mtime, st.st_size]
+        
+        if record is not None and record['stat'] == stat:
+            return dict(record)
+        
+        with open(path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        
+        # PIL reads only image header here
+        image = PIL.Image.open(path)
+        
+        return {'stat': stat,
+                'size': list(image.size),
+                'format': image.format,
+                'hash': digest}
+    
+    def _find_variants(self, where, record, fnames):
+        ''' Finds variants of image among file names from its directory '''
+        dirname, fname = os.path.split(where)
+        base, _ = os.path.splitext(fname)
+        
+        for key, suffix in self.VARIANTS:
+            variant = base + suffix
+            record[key] = os.path.join(dirname, variant) if variant in fnames else None
+        
+        scaled = []
+        for fname in fnames:
+            match = self.SCALED_NAME_RE.match(fname)
+            if match is not None and match.group(1) == base:
+                scaled.append((int(match.group(2)), os.path.join(dirname, fname)))
+        
+        record['scaled'] = [path for _, path in sorted(scaled)]
+    
+    def get(self, where):
+        ''' Returns ImageInfo for image path relative to image directory.
+        Images which appeared after catalog was refreshed are added to
+        it, missing images raise OSError '''
+        where = os.path.normpath(where)
+        
+        record = self.images.get(where)
+        if record is None:
+            record = self._refresh_image(where, None)
+            dirname = os.path.dirname(self.get_path(where))
+            self._find_variants(where, record, set(os.listdir(dirname)))
+            
+            self.images[where] = record
+        
+        return ImageInfo(where, record)
+    
+    def get_path(self, path):
+        ''' Returns path of file in image directory '''
+        return os.path.join(self.image_dir, path)
@@ -0,0 +1,45 @@
+'''
+TSDoc source listing store
+
+Source files included into pages with ````` are shared by all pages through
+a store keyed by path. File contents is read only when printer asks for
+listing body, so builds which do not print sources never read them, and files
+included into multiple pages are read once. Missing files are reported when
+printer asks for their text or by gen-doc.py --check.
+'''
+
+import os
+
+class SourceListing(object):
+    def __init__(self, path):
+        self.path = path
+        self._text = None
+    
+    def get_text(self):
+        if self._text is None:
+            with open(self.path) as f:
+                self._text = f.read()
+        
+        return self._text
+
+class ListingStore(object):
+    def __init__(self):
+        self.listings = {}
+    
+    @staticmethod
+    def stat_file(path):
+        ''' Returns pair of modification time and size of file '''
+        st = os.stat(path)
+        return (st.st_mtime, st.st_size)
+    
+    def get(self, path):
+        key = os.path.normpath(path)
+        
+        listing = self.listings.get(key)
+        if listing is None:
+            listing = SourceListing(path)
+            self.listings[key] = listing
+        
+        return listing
+
+listing_store = ListingStore()
@@ -3,6 +3,8 @@ from tsdoc.blocks import *
 import re
 import os
 import string 
+import bisect
+import time
 
 class _Frame(object):
     def __init__(self, cls, idx, tail=None, **options):
@@ -13,14 +15,50 @@ class _Frame(object):
         self.text = []                   # Array of text chunks
         self.options = options
 
+def _build_dispatch(char_table):
+    # Indexes CHAR_TABLE by trigger character: each character maps to the list
+    # of (charcls, func) entries whose class contains it, in table order
+    dispatch = {}
+    for charcls, func in char_table:
+        for char in set(charcls):
+            dispatch.setdefault(char, []).append((charcls, func))
+    
+    return dispatch
+
+def _build_scanner(chars):
+    # Builds regex that seeks for next character which may start a markup
+    return re.compile('[{0}]'.format(''.join(re.escape(char) 
+                                             for char in sorted(chars))))
+
+class _TailMatcher(object):
+    # Matches set of active tails ordered by priority (top of the stack goes
+    # first). regex has a group per tail, so lastindex refers to the frame
+    # which tail is matched, scanner seeks for next tag or tail position
+    def __init__(self, tails, trigger_chars):
+        self.regex = None
+        if tails:
+            self.regex = re.compile('|'.join('({0})'.format(re.escape(tail))
+                                             for tail in tails))
+        
+        self.scanner = _build_scanner(set(trigger_chars) | 
+                                      set(tail[0] for tail in tails))
+
 class MarkdownParseError(Exception):
-    def __init__(self, idx, message, stack):
+    def __init__(self, idx, message, stack, name='', lineno=None, colno=None):
         self.idx = idx
         self.message = message
         self.stack = stack
+        
+        self.name = name
+        self.lineno = lineno
+        self.colno = colno
     
     def __str__(self):
-        lines = ['error at {0}: {1}, parser stack:'.format(self.idx, self.message)]
+        where = self.idx
+        if self.lineno is not None:
+            where = '{0}:{1}:{2}'.format(self.name, self.lineno, self.colno)
+        
+        lines = ['error at {0}: {1}, parser stack:'.format(where, self.message)]
         for frame in self.stack:
             optstr = ', '.join('{0}={1}'.format(k, v) 
                                for k,v in frame.options.items())
@@ -31,9 +69,21 @@ class MarkdownParseError(Exception):
         return '\n'.join(lines)
 
 class MarkdownParser(object):
+    # Version of block trees produced by parser. Increase it whenever
+    # parser output or layout of block classes is changed, so cached block
+    # trees will be invalidated
+    VERSION = 3
+    
     TRACE = (os.environ.get('MDTRACE') == '1')
     LAST_TRACED_IDX = -1
     
+    # Per-handler profiling counters: name -> [calls, rejected calls, time]
+    # They are kept in the class, so they only account for parsers run
+    # in the current process: load_pages() uses a single job if profiling 
+    # is enabled, so MDPROFILE=1 implies TSDOC_JOBS=1
+    PROFILE = (os.environ.get('MDPROFILE') == '1')
+    PROFILE_STATS = {}
+    
     class _ctlcount(object):
         # Checks that count of control characters matches expected value
         def __init__(self, expected):
@@ -54,19 +104,14 @@ class MarkdownParser(object):
             
         def __call__(self, f):
             def wrapper(parser, idx, count):
-                # Look back previous newline
-                try:
-                    nlidx = parser.text.rindex('\n', 0, idx)
-                except ValueError:
-                    nlidx = 0
-                    
-                ws = parser.text[nlidx:idx]
-                if not all(c in string.whitespace 
-                           for c in ws):
+                # Lookup line which indentation ends at idx
+                lsidx = parser.line_indents.get(idx)
+                if lsidx is None:
                     return idx
                 
                 if self.ul:
-                    count = len(ws)
+                    # Count includes newline character preceding indentation
+                    count = idx - max(lsidx - 1, 0)
                 
                 return f(parser, idx, count)
             wrapper.__name__ = f.__name__
@@ -112,12 +157,34 @@ class MarkdownParser(object):
             wrapper.__name__ = f.__name__
             return wrapper
     
+    LINE_INDENT_RE = re.compile(r'^[ \t\r\x0b\x0c]*', re.M)
+    
     def __init__(self, text, name=''): 
         self.name = name
         self.text = text
         
         self.blocks = []
         self.stack = [_Frame(Paragraph, 0)]
+        self._tails = None               # Active tail frames and their matcher
+        
+        self._index_lines()
+    
+    def _index_lines(self):
+        # Builds line-offset index: sorted list of offsets where lines start
+        # and map of offsets where line indentation ends to line starts
+        self.line_starts = []
+        self.line_indents = {}
+        
+        for m in self.LINE_INDENT_RE.finditer(self.text):
+            self.line_starts.append(m.start())
+            self.line_indents[m.end()] = m.start()
+    
+    def _error(self, idx, message):
+        lineno = bisect.bisect_right(self.line_starts, idx)
+        colno = idx - self.line_starts[lineno - 1] + 1
+        
+        return MarkdownParseError(idx, message, self.stack, 
+                                  self.name, lineno, colno)
     
     def _trace1(self, idx, idx2):
         if self.TRACE and self.LAST_TRACED_IDX != idx:
@@ -132,6 +199,23 @@ class MarkdownParser(object):
         if self.TRACE:
             print '\t' + fmtstr.format(*args, **kwargs)
         
+    def _profile_call(self, func, idx, count):
+        stats = self.PROFILE_STATS.setdefault(func.__name__, [0, 0, 0.0])
+        
+        start = time.time()
+        nidx = func(self, idx, count)
+        
+        stats[0] += 1
+        stats[2] += time.time() - start
+        if not nidx > idx:
+            stats[1] += 1
+        
+        return nidx
+    
+    @classmethod
+    def reset_profile(cls):
+        cls.PROFILE_STATS.clear()
+    
     def _count(self, charcls, idx):
         count = 0
         
@@ -167,15 +251,18 @@ class MarkdownParser(object):
         self._trace2('PUSH {0} {1} {2}', frame.cls.__name__, repr(frame.tail), frame.options)
         
         if top.idx != idx:
-            top.text.append(self.text[top.idx:idx])
+            top.text.append(intern_text(self.text[top.idx:idx]))
             top.idx = idx
         
         self.stack.append(frame)
+        self._tails = None
 
-    def _pop(self, idx, eidx, frame=None):
+    def _pop(self, idx, eidx, frame=None, post_pop=True):
         top = self.stack.pop()
+        self._tails = None
+        
         if idx != top.idx:
-            top.text.append(self.text[top.idx:idx])
+            top.text.append(intern_text(self.text[top.idx:idx]))
         
         self._trace2('POP {0:x} {1} {2} {3}', id(top), top.cls.__name__, len(self.stack), len(self.blocks))
         
@@ -205,60 +292,124 @@ class MarkdownParser(object):
         
         if frame and top is not frame:
             self._trace2('UNWIND {0:x} {1}', id(frame), frame.cls.__name__)
-            self._pop(idx, eidx, frame)
+            self._pop(idx, eidx, frame, post_pop)
             return
         
-        self._call_handlers(self.POST_POP_TABLE, idx, newtop)
+        if post_pop:
+            self._call_handlers(self.POST_POP_TABLE, idx, newtop)
     
-    def _check_tail(self, idx):
+    def _get_tails(self):
+        # Returns frames which tails may be matched and matcher for them. They 
+        # are cached until stack is changed by _push() or _pop()
+        if self._tails is not None:
+            return self._tails
+        
+        frames = []
         for frame in reversed(self.stack):
             if not frame.tail:
                 continue
             
-            tidx = idx + len(frame.tail)
-            
-            if self.text[idx:tidx] == frame.tail:
-                # Recursively pop elements unless frame is popped out of stack    
-                self._trace1(idx, tidx)
-                self._trace2('TAILCHK {0:x} {1} {2}', id(frame), frame.cls.__name__, repr(frame.tail))
-                self._pop(idx, tidx, frame)
-                return tidx
+            frames.append(frame)
             
             if issubclass(frame.cls, Incut) or issubclass(frame.cls, Code):
-                return idx
+                break
         
-        return idx
+        tails = tuple(frame.tail for frame in frames)
+        
+        matcher = self.TAIL_MATCHERS.get(tails)
+        if matcher is None:
+            matcher = _TailMatcher(tails, self.CHAR_DISPATCH)
+            self.TAIL_MATCHERS[tails] = matcher
+        
+        self._tails = (frames, matcher)
+        return self._tails
+    
+    def _check_tail(self, idx):
+        frames, matcher = self._get_tails()
+        if matcher.regex is None:
+            return idx
+        
+        m = matcher.regex.match(self.text, idx)
+        if m is None:
+            return idx
+        
+        frame = frames[m.lastindex - 1]
+        tidx = m.end()
+        
+        # Recursively pop elements unless frame is popped out of stack    
+        self._trace1(idx, tidx)
+        self._trace2('TAILCHK {0:x} {1} {2}', id(frame), frame.cls.__name__, repr(frame.tail))
+        self._pop(idx, tidx, frame)
+        return tidx
+        
+    def _parse_at(self, idx):
+        # Checks tails and tags at idx, returns index of next character to check
+        tidx = self._check_tail(idx)
+        if tidx != idx:
+            return tidx
+        
+        char = self.text[idx]
         
+        for charcls, func in self.CHAR_DISPATCH.get(char, ()):
+            count = self._count(charcls, idx) # Forward-look count of the "control characters"
+            
+            self._trace1(idx, idx + count)
+            self._trace2('CALL {0} {1:4} {2:16}', count, repr(char), func.__name__)
+            
+            if self.PROFILE:
+                nidx = self._profile_call(func, idx, count)
+            else:
+                nidx = func(self, idx, count)
+            
+            if nidx > idx:     # if index was advanced, sequence was successfully parsed
+                return nidx
+        
+        return idx + 1
+    
+    def _parse_range(self, idx, end):
+        # Parses text up to end index, returns index where parsing stopped 
+        # which may exceed end if some tag spans over it
+        while idx < end:
+            _, matcher = self._get_tails()
+            m = matcher.scanner.search(self.text, idx, end)
+            if m is None:
+                return end
+            
+            idx = self._parse_at(m.start())
+        
+        return idx
+    
     def parse(self):
+        self.blocks = list(self.parse_iter())
+        return self.blocks
+    
+    def parse_iter(self):
+        ''' Generator version of parse(): yields each top-level block as soon 
+        as it is complete, so caller may process it while parsing continues. 
+        Yielded blocks are not kept in self.blocks '''
         idx = 0
         length = len(self.text)
         
         while idx < length:
-            char = self.text[idx]
+            # Hand out blocks completed by previous step
+            if self.blocks:
+                blocks, self.blocks = self.blocks, []
+                for block in blocks:
+                    yield block
             
-            tidx = self._check_tail(idx)
-            if tidx != idx:
-                idx = tidx
-                continue
+            # Skip plain text which can't contain markup or tails
+            _, matcher = self._get_tails()
+            m = matcher.scanner.search(self.text, idx)
+            if m is None:
+                break
             
-            for charcls, func in self.CHAR_TABLE:
-                if char in charcls:
-                    count = self._count(charcls, idx) # Forward-look count of the "control characters"
-                    
-                    self._trace1(idx, idx + count)
-                    self._trace2('CALL {0} {1:4} {2:16}', count, repr(char), func.__name__)
-                    
-                    nidx = func(self, idx, count)
-                    
-                    if nidx > idx:     # if index was advanced, sequence was successfully parsed
-                        idx = nidx
-                        break
-            else:
-                idx += 1
+            idx = self._parse_at(m.start())
         
         self._pop(length, length, self.stack[0])   # unwind stack
         
-        return self.blocks
+        blocks, self.blocks = self.blocks, []
+        for block in blocks:
+            yield block
     
     # -------------------------------
     # Tag parsers -- they are chosen from CHAR_TABLE table and being called for each matched character
@@ -268,7 +419,7 @@ class MarkdownParser(object):
         # Create a new chunk of text on the escape symbol
         top = self.stack[-1]
         
-        top.text.append(self.text[top.idx:idx])
+        top.text.append(intern_text(self.text[top.idx:idx]))
         top.idx = idx + 1
         
         return idx + 2
@@ -278,7 +429,7 @@ class MarkdownParser(object):
     def _endash(self, idx, count):
         top = self.stack[-1]
         
-        top.text.append(self.text[top.idx:idx])
+        top.text.append(intern_text(self.text[top.idx:idx]))
         top.text.append(u'\u2013'.encode('utf-8'))
         top.idx = idx + 1
         
@@ -408,8 +559,7 @@ class MarkdownParser(object):
         fname = options.strip()
         frame = _Frame(CodeListing, idx + count, fname=fname)
         
-        with open(fname) as f:
-            frame.text.append(f.read())
+        # Contents is loaded by CodeListing when printer needs it
         
         self._push(idx, frame)
         self._pop(idx + count, idx + count)
@@ -436,7 +586,7 @@ class MarkdownParser(object):
     
     @_ctlcount(4)
     def _breakpoint(self, idx, count):
-        raise MarkdownParseError(idx, 'breakpoint', self.stack)
+        raise self._error(idx, 'breakpoint')
     
     @_block()
     @_ignore(Code)
@@ -445,7 +595,7 @@ class MarkdownParser(object):
     def _incut(self, idx, count, options):
         style = options.strip()
         if not style:
-            raise MarkdownParseError(idx, 'incut has empty style', self.stack)
+            raise self._error(idx, 'incut has empty style')
         if style[0] == 'F':
             coords = dict((k, float(v))
                           for k, v 
@@ -489,10 +639,99 @@ class MarkdownParser(object):
                 frame.options['colwidths'] = widths
         
         self._push(idx, frame)
+        
+        # Fast path requires opening line to be complete
+        if self.stack[-1] is frame and self.text[idx+count-1:idx+count] == '\n':
+            eidx = self._parse_table(frame, idx + count)
+            if eidx is not None:
+                return eidx
+        
         self._post_pop_row(idx + count, None)
         
         return idx + count
     
+    def _parse_table(self, table, idx):
+        # Table fast path: finds row and cell boundaries of the whole table in 
+        # a single pass, then parses cell contents between them with table frames
+        # excluded from tail matching. Frames are pushed and popped exactly as 
+        # _post_pop_row() and _post_pop_cell() do. Returns index after the table
+        # or None if table should be parsed through these callbacks.
+        text = self.text
+        if text[idx+1:idx+4] == '---':
+            return None
+        
+        bounds = []
+        for m in self.TABLE_TOKEN_RE.finditer(text, idx):
+            token = m.group()
+            if token == '---':
+                end = m.start()
+                break
+            if token in ('|', '\n'):
+                bounds.append(m.start())
+        else:
+            return None
+        
+        # Tags which seek over cell boundaries or break them (code blocks and 
+        # incuts are barriers for tails, list entries may unwind outer list) 
+        # are left to callbacks
+        if (text.find('___', idx, end) != -1 or
+                self.TABLE_BLOCK_RE.search(text, idx, end)):
+            return None
+        if (any(frame.cls is ListBlock for frame in self.stack) and
+                self.TABLE_LIST_RE.search(text, idx, end)):
+            return None
+        
+        table.tail = None
+        self._tails = None
+        
+        # Outer frames' tails inside table would unwind it
+        frames, _ = self._get_tails()
+        region = text[idx:end]
+        if any(frame.tail in region for frame in frames):
+            return self._resume_table(None, table)
+        
+        row, cell = self._push_row(idx, None, None)
+        
+        for bidx in bounds:
+            pidx = self._parse_range(idx, bidx)
+            if pidx != bidx:
+                return self._resume_table(pidx, table, row, cell)
+            
+            idx = bidx + 1
+            
+            if text[bidx] == '|':
+                self._pop(bidx, idx, cell, post_pop=False)
+                if cell in self.stack:
+                    return self._resume_table(idx, table, row, cell)
+                
+                cell = self._push_cell(bidx, None)
+            else:
+                self._pop(bidx, idx, row, post_pop=False)
+                if row in self.stack:
+                    return self._resume_table(idx, table, row, cell)
+                
+                row = cell = None
+                if text[idx:idx+3] != '---':
+                    row, cell = self._push_row(bidx, None, None)
+        
+        pidx = self._parse_range(idx, end)
+        if pidx != end:
+            return self._resume_table(pidx, table, row, cell)
+        
+        self._pop(end, end + 3, table)
+        return self._resume_table(end + 3, table, row, cell)
+    
+    def _resume_table(self, idx, table, row=None, cell=None):
+        # Restores tails of table frames so table is parsed by callbacks from idx
+        table.tail = '---'
+        if row is not None:
+            row.tail = '\n'
+        if cell is not None:
+            cell.tail = '|'
+        
+        self._tails = None
+        return idx
+    
     CHAR_TABLE = [
         ('$$$$', _breakpoint),
         ('\\', _escape),
@@ -516,6 +755,19 @@ class MarkdownParser(object):
         ('---', _table)
         ]
     
+    CHAR_DISPATCH = _build_dispatch(CHAR_TABLE)
+    
+    # Cache of tail matchers shared by all parsers, keyed by tuple of tails
+    TAIL_MATCHERS = {}
+    
+    # Table grammar: cell and row boundaries (escaped characters are not), 
+    # lines starting with tags that are not handled by table fast path and
+    # cell's colspan,rowspan 
+    TABLE_TOKEN_RE = re.compile(r'\\.|\||\n|---', re.S)
+    TABLE_BLOCK_RE = re.compile(r'^[ \t\r\x0b\x0c]*(?:```|!!!|>>>>>)', re.M)
+    TABLE_LIST_RE = re.compile(r'^[ \t\r\x0b\x0c]*\*', re.M)
+    CELL_SPAN_RE = re.compile(r'(\d+),(\d+)')
+    
     # -------------------------------
     # Block pre- and post-processing. Before removing block from stack they pre-process some data in it depending
     # on block class
@@ -569,10 +821,18 @@ class MarkdownParser(object):
         if tail == '---':
             return
         
-        self._push(idx, _Frame(TableRow, idx, tail='\n'))
-        self._post_pop_cell(idx, None)
+        self._push_row(idx, '\n', '|')
     
     def _post_pop_cell(self, idx, top):
+        self._push_cell(idx, '|')
+    
+    def _push_row(self, idx, tail, cell_tail):
+        row = _Frame(TableRow, idx, tail=tail)
+        self._push(idx, row)
+        
+        return row, self._push_cell(idx, cell_tail)
+    
+    def _push_cell(self, idx, tail):
         # Parse cell's rowspan, colspan
         char = self.text[idx]
         if char == '|':
@@ -580,15 +840,16 @@ class MarkdownParser(object):
         if char == '\n':
             idx += 1
         
-        regex = re.compile('(\d+),(\d+)')
-        m = regex.match(self.text, idx)
+        m = self.CELL_SPAN_RE.match(self.text, idx)
         if m:
-            self._push(idx, _Frame(TableCell, m.end(), tail='|',
-                                   colspan=int(m.group(1)),
-                                   rowspan=int(m.group(2))))
-            return
+            cell = _Frame(TableCell, m.end(), tail=tail,
+                          colspan=int(m.group(1)),
+                          rowspan=int(m.group(2)))
+        else:
+            cell = _Frame(TableCell, idx, tail=tail)
         
-        self._push(idx, _Frame(TableCell, idx, tail='|'))
+        self._push(idx, cell)
+        return cell
     
     POST_POP_TABLE = [
         (Table, _post_pop_row),
@@ -645,10 +906,8 @@ More text
         """
 
     parser = MarkdownParser(text)    
-    blocks = parser.parse()
-    
-    print '-----------------'
     
-    for block in blocks:
+    for block in parser.parse_iter():
+        print '-----------------'
         pprint_block(block)
         
\ No newline at end of file
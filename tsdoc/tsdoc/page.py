@@ -1,15 +1,24 @@
 import os
 import sys
 
+import multiprocessing
+
 from pprint import pprint
+from StringIO import StringIO
 
 from collections import defaultdict, OrderedDict
 
 from tsdoc import *
 from tsdoc.blocks import *
 from tsdoc.mdparser2 import MarkdownParser
+from tsdoc.cache import ParseCache
+from tsdoc.depgraph import DependencyGraph
+from tsdoc.search import SearchIndex
+from tsdoc.compress import Precompressor
 
 VERBOSE = os.getenv('TSDOC_VERBOSE', None) is not None
+CACHE_DIR = os.getenv('TSDOC_CACHE_DIR', None)
+DEPGRAPH_PATH = os.getenv('TSDOC_DEPGRAPH', None)
 _TRACE_DOCS = []
 
 class TSDocProcessError(Exception):
@@ -30,8 +39,11 @@ class DocPage(object):
         self.references = {}
         
         self.nav_links = {}
+        self.link_targets = set()
         
         self.doc_path = None
+        
+        self._part_index = None
     
     def __iter__(self):
         return iter(self.blocks)
@@ -53,25 +65,15 @@ class DocPage(object):
     def set_format(self, doc_format):
         self.format = doc_format
         
-    def iter_parts(self, pred):
-        ''' Generator - iteratively other all blocks/parts 
-        and returns those that match predicate. 
-        
-        Allows to avoid recursive algorithms'''
-        for block in self.blocks:
-            for part in self._iter_parts_block(pred, block):
-                yield part
-    
-    def _iter_parts_block(self, pred, block, level = 0):
-        for part in block:
-            if pred(part):
-                yield part
-            
-            if isinstance(part, Block):
-                parts = self._iter_parts_block(pred, part, level + 1)
-                for block_part in parts:
-                    yield block_part
+    def get_part_index(self):
+        ''' Returns PartIndex of page blocks. It is built on first call, 
+        so all top-level blocks should be added to page before that.
+        Because index entries refer to top-level blocks, removed blocks
+        may be filtered out by the caller '''
+        if self._part_index is None:
+            self._part_index = PartIndex(self.blocks)
         
+        return self._part_index
     
     def add_nav_link(self, nav_type, page):
         where = self.gen_link_to(page)
@@ -88,6 +90,8 @@ class DocPage(object):
             link.text = self.header
 
 class MarkdownPage(DocPage):
+    _parse_cache = None
+    
     def __init__(self, page_path):
         path, name = os.path.split(page_path)
         _, docspace = os.path.split(path)
@@ -100,8 +104,113 @@ class MarkdownPage(DocPage):
         text = fp.read()
         fp.close()
         
+        self._parse(text)
+    
+    def _parse(self, text):
+        cache = MarkdownPage._get_parse_cache()
+        if cache is not None:
+            blocks = cache.load(text)
+            if blocks is not None:
+                self.blocks = blocks
+                self._part_index = PartIndex(blocks)
+                return
+        
+        # Blocks are indexed as soon as parser completes them, so index 
+        # is ready when parsing is finished
+        self._part_index = PartIndex([])
+        
         parser = MarkdownParser(text, self.page_path)
-        self.blocks = parser.parse()
+        for block in parser.parse_iter():
+            self.blocks.append(block)
+            self._part_index.add_block(block)
+        
+        if cache is not None:
+            cache.store(text, self.blocks)
+    
+    @staticmethod
+    def _get_parse_cache():
+        if CACHE_DIR and MarkdownPage._parse_cache is None:
+            MarkdownPage._parse_cache = ParseCache(CACHE_DIR)
+        
+        return MarkdownPage._parse_cache
+
+def load_pages(page_paths, jobs=None):
+    ''' Parses markdown pages in a pool of worker processes. Returns
+    list of MarkdownPage objects in the same order as page_paths. 
+    
+    jobs is a number of workers, by default - number of cpus. Profiling
+    counters of parser are not passed back from workers, so pages are 
+    parsed in this process when MDPROFILE is set '''
+    if jobs == 1 or len(page_paths) < 2 or MarkdownParser.PROFILE:
+        return map(MarkdownPage, page_paths)
+    
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # Pages are very different in size, so hand them one by one 
+        return pool.map(MarkdownPage, page_paths, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def _is_same_file(path, text):
+    # Compare sizes first, so changed documents are rarely read
+    try:
+        if os.path.getsize(path) != len(text):
+            return False
+        
+        with open(path, 'rb') as f:
+            return f.read() == text
+    except (IOError, OSError):
+        return False
+
+def _print_page(printer, header, page):
+    ''' Prints page into memory and writes it to its document only if
+    document contents is changed, so modification times of unchanged 
+    documents are kept. Returns True if document was written '''
+    stream = StringIO()
+    printer.do_print(stream, header, page)
+    text = stream.getvalue()
+    
+    if _is_same_file(page.doc_path, text):
+        return False
+    
+    with open(page.doc_path, printer.stream_mode) as f:
+        f.write(text)
+    
+    return True
+
+# Printer and pages for print_pages() workers. They are set before pool
+# is created, so forked workers inherit them and get their own copies of
+# the printer with its state and of pages with all pages they refer to
+_print_task = None
+
+def _print_page_worker(idx):
+    printer, header, pages = _print_task
+    return _print_page(printer, header, pages[idx])
+
+def print_pages(printer, header, pages, jobs=None):
+    ''' Prints pages into their documents in a pool of worker processes. 
+    Pages should be cross-referenced, so they don't depend on each other. 
+    Returns number of written documents, others were not changed.
+    
+    jobs is a number of workers, by default - number of cpus '''
+    global _print_task
+    
+    if jobs == 1 or len(pages) < 2 or not hasattr(os, 'fork'):
+        return sum(_print_page(printer, header, page) 
+                   for page in pages)
+    
+    _print_task = (printer, header, pages)
+    try:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            return sum(pool.map(_print_page_worker, range(len(pages)), 
+                                chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _print_task = None
 
 class IncompletePage(DocPage):
     def __init__(self, page_path):
@@ -175,6 +284,41 @@ class IndexPage(MarkdownPage):
                 
                 self.blocks.append(block) 
     
+    class BookIndex(object):
+        ''' Book-wide index of pages and anchors. Maps "docspace/page" to page
+        objects and "docspace/page#anchor" to Reference objects, so internal
+        links are resolved without scanning docspaces '''
+        def __init__(self):
+            self.docspaces = {}
+            self.pages = {}
+            self.anchors = {}
+        
+        def add_docspace(self, docspace, pages):
+            # If multiple index entries refer to the same docspace, 
+            # the first one is used to resolve links
+            self.docspaces.setdefault(docspace.docspace, docspace)
+            
+            for name, page in pages.items():
+                self.add_page(docspace.docspace, name, page)
+        
+        def add_page(self, docspace_name, name, page):
+            self.pages['%s/%s' % (docspace_name, name)] = page
+        
+        def add_reference(self, page, ref):
+            # HTML and PDF printers name anchors after get_name() while
+            # EPUB uses text of the reference, so accept both in links
+            for name in (ref.text, ref.get_name()):
+                self.anchors['%s/%s#%s' % (page.docspace, page.name, name)] = ref
+        
+        def find_page(self, where):
+            if '#' in where:
+                where = where[:where.rfind('#')]
+            
+            return self.pages.get(where)
+        
+        def find_anchor(self, where):
+            return self.anchors.get(where)
+    
     class DocSpaceIndex(DocPage):
         def __init__(self, header, docspace, is_external=False, gen_reference=False, ref_prefix = ''):
             name = 'index'
@@ -190,9 +334,11 @@ class IndexPage(MarkdownPage):
             
             self.reference = None
         
-        def process(self, pages, docspaces):
+        def process(self, pages, book_index):
             self.pages = pages
-            self.docspaces = docspaces
+            self.book_index = book_index
+            
+            book_index.add_docspace(self, pages)
             
             # Collect links and references from all pages
             for page in self.pages.values():
@@ -217,6 +363,7 @@ class IndexPage(MarkdownPage):
                 
                 self.pages = OrderedDict()                
                 self.pages['__index__'] = self
+                self.book_index.add_page(self.docspace, '__index__', self)
                 
                 for name, page in pages.items():
                     self.pages[name] = page
@@ -252,16 +399,21 @@ class IndexPage(MarkdownPage):
                     stream = open(self.doc_path, printer.stream_mode)
                     printer.do_print_pages(stream, self.header, pages)
             else:    
+                pages = []
                 for page in self.pages.values():
-                    if VERBOSE:
-                        print 'Generating %s...' % page.doc_path
                     if not os.path.isdir(os.path.dirname(page.doc_path)):
                         print >> sys.stderr, 'WARNING: Directory "%s" does not exist' % (os.path.dirname(page.doc_path))
                         continue
-                    stream = open(page.doc_path, printer.stream_mode)
-                    printer.do_print(stream, self.header, page)
+                    pages.append(page)
+                
+                index.generate_pages(printer, self.header, pages)
         
         def find_page(self, link):
+            page = self.book_index.find_page(link.where)
+            if page is not None:
+                return page
+            
+            # Page is not in the index, find out why to report it
             docspace_name, name = link.where.split('/')            
             docspace = self
             
@@ -270,10 +422,8 @@ class IndexPage(MarkdownPage):
                 name = name[:name.rfind('#')]
             
             if docspace_name != self.docspace:
-                for docspace in self.docspaces:
-                    if docspace_name == docspace.docspace:
-                        break
-                else:
+                docspace = self.book_index.docspaces.get(docspace_name)
+                if docspace is None:
                     print >> sys.stderr, 'WARNING: Invalid link "%s" in docspace "%s"' % (link.where,
                                                                                           self.docspace)
                     return None 
@@ -287,41 +437,37 @@ class IndexPage(MarkdownPage):
                 return None
         
         def _collect_ref_links(self, page, is_index):
-            def pred(part):
-                return isinstance(part, Reference) or \
-                       (isinstance(part, Link) and part.type == Link.INTERNAL)
+            part_index = page.get_part_index()
+            
+            for part, _ in part_index.references:
+                full_ref = '%s/%s#%s' % (page.docspace, page.name,
+                                         part.get_name())
+                self.references[full_ref] = part
+                self.book_index.add_reference(page, part)
             
             links = []
             
-            for part in page.iter_parts(pred):
-                if isinstance(part, Reference):
-                    full_ref = '%s/%s#%s' % (page.docspace, page.name,
-                                             part.get_name())
-                    self.references[full_ref] = part
-                else:
-                    if is_index:
-                        page.set_header_from_link(part)
-                    links.append((page, part))
+            for part, _ in part_index.internal_links:
+                if is_index:
+                    page.set_header_from_link(part)
+                links.append((page, part))
             
             return links
         
         def _gen_nav_links(self, index_links, index):
-            for (prev, cur, next) in zip([None] + index_links[:-1],
-                                         index_links, 
-                                         index_links[1:] + [None]):
-                cur_page = self.find_page(cur[1])
-                
+            index_pages = [self.find_page(link) 
+                           for _, link in index_links]
+            
+            for (prev_page, cur_page, next_page) in zip([None] + index_pages[:-1],
+                                                        index_pages, 
+                                                        index_pages[1:] + [None]):
                 if cur_page is None:
                     continue
                 
-                if prev is not None:
-                    prev_page = self.find_page(prev[1])
-                    if prev_page is not None:
-                        cur_page.add_nav_link(NavLink.PREV, prev_page)
-                if next is not None:
-                    next_page = self.find_page(next[1])
-                    if next_page is not None:
-                        cur_page.add_nav_link(NavLink.NEXT, next_page)
+                if prev_page is not None:
+                    cur_page.add_nav_link(NavLink.PREV, prev_page)
+                if next_page is not None:
+                    cur_page.add_nav_link(NavLink.NEXT, next_page)
                 
                 if self.is_external:    
                     cur_page.add_nav_link(NavLink.UP, self)
@@ -348,6 +494,11 @@ class IndexPage(MarkdownPage):
             
             self.pages[name] = page
             
+            # Register placeholder in book index, so following links to the 
+            # same page are resolved to it instead of creating another one
+            docspace_name, page_name = name.split('/')
+            self.book_index.add_page(docspace_name, page_name, page)
+            
             return page
             
         def _xref(self, index, links):
@@ -360,41 +511,158 @@ class IndexPage(MarkdownPage):
                 if page is None:
                     page = self._create_incomplete_page(index, link.where)
                 
+                where = link.where
+                if '#' in where:
+                    anchor = where[link.where.rfind('#'):]
+                else:
+                    anchor = ''
+                
                 if isinstance(page, IncompletePage):
                     link.type = Link.INVALID
                     print >> sys.stderr, 'WARNING: Not found page for link "%s" for page %s' % (link, refpage)
                 else:
+                    # Link to unknown anchor still leads to existing page,
+                    # so it is only reported
+                    if anchor and self.book_index.find_anchor(where) is None:
+                        print >> sys.stderr, 'WARNING: Not found anchor "%s" for link "%s" for page %s' % (anchor[1:], link, refpage)
+                    
                     link.type = Link.EXTERNAL
                 
+                refpage.link_targets.add(page.page_path)
+                
                 # Not all page headers are set in _collect_ref_links()
                 # so set them here but only if reference page is an docspace index page
                 if isinstance(refpage, IndexPage.DocSpaceIndex):
                     page.set_header_from_link(link)
                 
-                where = link.where
-                if '#' in where:
-                    anchor = where[link.where.rfind('#'):]
-                else:
-                    anchor = ''
-                
                 link.where = refpage.gen_link_to(page) + anchor
         
-    def __init__(self, page_path, doc_header, pages): 
+    def __init__(self, page_path, doc_header, pages, jobs=None): 
         MarkdownPage.__init__(self, page_path)
         self.header = doc_header
         self.docspace = ''
         
+        if not isinstance(pages, dict):
+            # List of paths to markdown pages
+            pages = self._load_pages(pages, jobs)
+        
         self.pages = pages
         self.reference = None
         
         self._process_index()
         
-    def generate(self, printer, doc_dir, doc_suffix):
+    def _load_pages(self, page_paths, jobs=None):
+        ''' Parses only pages of docspaces which are declared in index page
+        by __docspace__ tags. Pages of other docspaces are never printed,
+        but all pages of declared docspaces are, even if no link refers to
+        them. Returns pages grouped by docspace in the same order as 
+        page_paths like gen-doc.py does when all pages are parsed. '''
+        docspaces = set()
+        for ref, _ in self.get_part_index().references:
+            tag, value = ref.parse()
+            if tag == '__docspace__':
+                docspaces.add(value)
+        
+        load_paths = [path for path in page_paths
+                      if os.path.basename(os.path.dirname(path)) in docspaces]
+        
+        if VERBOSE:
+            print '\nLoading %d of %d pages, other pages are not in docspaces ' \
+                  'of index' % (len(load_paths), len(page_paths))
+        
+        pages = defaultdict(OrderedDict)
+        for page in load_pages(load_paths, jobs):
+            pages[page.docspace].setdefault(page.name, page)
+        
+        return pages
+    
+    def check(self, image_dir=None):
+        ''' Validates book without generating it: resolves internal links
+        and anchors through book index and checks that images and listings 
+        exist. Images are looked up in image_dir (if it is set), PNG images 
+        may also be built from SVG files with the same name.
+        
+        Returns pair of dictionary with numbers of checked objects and
+        list of errors. Each error is a dictionary with keys 'type', 'page'
+        and 'target' and optional 'text' with text of the link. '''
+        counts = defaultdict(int)
+        errors = []
+        
+        def error(type, page, target, text=None):
+            error = {'type': type, 'page': page.page_path, 'target': target}
+            if text is not None:
+                error['text'] = text
+            errors.append(error)
+        
+        pages = OrderedDict()
+        pages[id(self)] = self
+        
+        for docspace in self.docspaces:
+            for page in [docspace] + docspace.pages.values():
+                pages.setdefault(id(page), page)
+            
+            for refpage, link in docspace.links:
+                if link.type != Link.INTERNAL:
+                    continue
+                
+                counts['links'] += 1
+                
+                if link.where.count('/') != 1:
+                    error('link', refpage, link.where, str(link))
+                elif self.book_index.find_page(link.where) is None:
+                    error('page', refpage, link.where, str(link))
+                elif '#' in link.where:
+                    counts['anchors'] += 1
+                    if self.book_index.find_anchor(link.where) is None:
+                        error('anchor', refpage, link.where, str(link))
+        
+        for page in pages.values():
+            counts['pages'] += 1
+            part_index = page.get_part_index()
+            
+            for image, _ in part_index.images:
+                if image_dir is None:
+                    break
+                
+                counts['images'] += 1
+                
+                path = os.path.join(image_dir, image.where)
+                if not os.path.isfile(path) and \
+                        not (path.endswith('.png') and 
+                             os.path.isfile(path[:-4] + '.svg')):
+                    error('image', page, image.where, str(image))
+            
+            for listing, _ in part_index.listings:
+                counts['listings'] += 1
+                
+                if not os.path.isfile(listing.fname):
+                    error('listing', page, listing.fname)
+        
+        return dict(counts), errors
+    
+    def generate(self, printer, doc_dir, doc_suffix, jobs=None, 
+                 depgraph_path=DEPGRAPH_PATH):
         self.doc_dir = doc_dir
         self.doc_suffix = doc_suffix
+        self.jobs = jobs
+        
+        # Number of written documents and documents which were not
+        # changed, including those which were not printed at all
+        self.written = 0
+        self.unchanged = 0
+        
+        # Paths of all documents of the book relative to doc_dir, 
+        # including those which were not changed
+        self.outputs = []
         
         self.create_doc_path(doc_dir, doc_suffix)
         
+        printer.prepare(doc_dir)
+        
+        self.depgraph = None
+        if depgraph_path and printer.incremental and not printer.single_doc:
+            self.depgraph = DependencyGraph(depgraph_path, printer)
+        
         for docspace in self.docspaces:
             docspace.prepare(self)
         
@@ -418,13 +686,24 @@ class IndexPage(MarkdownPage):
         if not printer.single_doc:
             self._generate_reference(printer)
             
-            if VERBOSE:
-                print 'Generating index...'
-            
             self.prep_print()
+            self.generate_pages(printer, self.header, [self])
             
-            stream = open(self.doc_path, printer.stream_mode)
-            printer.do_print(stream, self.header, self)
+            if printer.search_index:
+                self._generate_search_index()
+            
+            if self.depgraph is not None:
+                self.depgraph.save()
+                
+                if VERBOSE:
+                    print '{0} pages are up to date'.format(self.depgraph.skipped)
+            
+            if printer.precompress:
+                outputs = self.outputs + printer.get_asset_paths()
+                compressed = Precompressor(doc_dir, self.jobs).run(outputs)
+                
+                if VERBOSE:
+                    print 'Compressed {0} files'.format(compressed)
         else:
             pages = [self]
             
@@ -439,6 +718,76 @@ class IndexPage(MarkdownPage):
             stream = open(self.doc_path, printer.stream_mode)
             printer.do_print_pages(stream, self.header, pages)
     
+    def generate_pages(self, printer, header, pages):
+        ''' Prints each page into its own document using print_pages(). 
+        If incremental build is enabled, page is skipped when it and all 
+        its dependencies are not changed since previous build '''
+        dirty_pages = []
+        
+        for page in pages:
+            self.outputs.append(os.path.relpath(page.doc_path, self.doc_dir))
+            
+            if self.depgraph is not None:
+                record = self.depgraph.collect(page, header)
+                if not self.depgraph.is_dirty(page, record):
+                    self.unchanged += 1
+                    continue
+                
+                if VERBOSE:
+                    changes = self.depgraph.get_changes(page)
+                    if changes:
+                        print 'Generating %s (changed %s)...' % (page.doc_path, 
+                                                                 ', '.join(changes))
+                    else:
+                        print 'Generating %s...' % page.doc_path
+            elif VERBOSE:
+                print 'Generating %s...' % page.doc_path
+            
+            dirty_pages.append(page)
+        
+        written = print_pages(printer, header, dirty_pages, self.jobs)
+        
+        self.written += written
+        self.unchanged += len(dirty_pages) - written
+    
+    def _generate_search_index(self):
+        ''' Writes search index of all book pages into search directory 
+        which is created in doc_dir. Index is built from block trees
+        of all pages, including those which were not printed by 
+        incremental build '''
+        search_index = SearchIndex()
+        
+        pages = OrderedDict()
+        for docspace in self.docspaces:
+            for page in docspace.pages.values():
+                if isinstance(page, (IncompletePage, IndexPage.DocSpaceIndex)):
+                    continue
+                pages.setdefault(id(page), page)
+        
+        for page in pages.values():
+            search_index.add_page(os.path.relpath(page.doc_path, self.doc_dir), 
+                                  page)
+        
+        search_dir = os.path.join(self.doc_dir, SearchIndex.DIRECTORY)
+        if not os.path.isdir(search_dir):
+            os.makedirs(search_dir)
+        
+        for name, data in search_index.get_files():
+            path = os.path.join(search_dir, name)
+            self.outputs.append(os.path.relpath(path, self.doc_dir))
+            
+            if _is_same_file(path, data):
+                self.unchanged += 1
+                continue
+            
+            if VERBOSE:
+                print 'Generating %s...' % path
+            
+            with open(path, 'wb') as f:
+                f.write(data)
+            
+            self.written += 1
+    
     def _generate_reference(self, printer):
         ref_docspace = IndexPage.DocSpaceIndex('reference', 'reference')
         
@@ -456,21 +805,17 @@ class IndexPage(MarkdownPage):
         reference.create_doc_path(self.doc_dir, self.doc_suffix)
         reference.add_nav_link(NavLink.UP, self)      
         
-        ref_docspace.process(pages, self.docspaces)
+        ref_docspace.process(pages, self.book_index)
         ref_docspace.prepare(self)
         ref_docspace._xref(self, reference.links)
         
-        if VERBOSE:
-            print 'Generating {0}...'.format(reference.doc_path)
-        
         # Generate index entry for reference
         hobj = Header(IndexPage.CHAPTER_HSIZE, [
                         Link(IndexPage.REFERENCE_LINK_TEXT, Link.EXTERNAL,
                              self.gen_link_to(reference))])
         self.blocks.append(hobj)
         
-        stream = file(reference.doc_path, 'w')
-        printer.do_print(stream, reference.header, reference)
+        self.generate_pages(printer, reference.header, [reference])
     
     def _process_index(self):
         # 1st pass - split index page into smaller indexes
@@ -543,7 +888,16 @@ class IndexPage(MarkdownPage):
         if docspace_index is not None:
             self.docspaces.append(docspace_index)
         
-        # 2nd pass - cross reference pages and links
+        # 2nd pass - cross reference pages and links. Pages and anchors
+        # of all docspaces are collected into a single book index
+        self.book_index = IndexPage.BookIndex()
+        
         for docspace_index in self.docspaces:
             docspace_name = docspace_index.docspace
-            docspace_index.process(self.pages[docspace_name], self.docspaces)
\ No newline at end of file
+            docspace_index.process(self.pages[docspace_name], self.book_index)
+
+# Nested classes are pickled by name, so they are also exported as module 
+# attributes to be kept in book bundles (see tsdoc.bundle)
+DocSpaceReference = IndexPage.DocSpaceReference
+BookIndex = IndexPage.BookIndex
+DocSpaceIndex = IndexPage.DocSpaceIndex
@@ -0,0 +1,112 @@
+'''
+TSDoc search index
+
+Builds inverted index of book pages for full-text search in HTML output
+which works without server: index is split into shards by first character
+of a term, so script in a page loads only shards for the terms it looks for.
+
+Each shard is a gzipped JSON object which maps terms to postings lists.
+Posting is a list of page number, name of anchor preceding the term (or
+empty string) and weight of the term in this place. Terms found in headers,
+__index__ references and code have larger weights than terms in text.
+Page numbers refer to the list of pages in the meta file 'index.json.gz',
+which also contains list of shards.
+'''
+
+import re
+import gzip
+import json
+
+from StringIO import StringIO
+from collections import defaultdict
+
+from tsdoc.blocks import *
+
+class SearchIndex(object):
+    DIRECTORY = 'search'
+    META_NAME = 'index'
+    SUFFIX = '.json.gz'
+    
+    TEXT_WEIGHT = 1
+    CODE_WEIGHT = 2
+    HEADER_WEIGHT = 10
+    REFERENCE_WEIGHT = 20
+    
+    MIN_TERM_LENGTH = 2
+    
+    # Should be the same as in search script in template.html
+    TERM_RE = re.compile('[a-z0-9_]+')
+    
+    def __init__(self):
+        self.pages = []
+        self.terms = defaultdict(lambda: defaultdict(int))
+    
+    def add_page(self, url, page):
+        page_id = len(self.pages)
+        self.pages.append([url, page.header])
+        
+        state = {'anchor': ''}
+        for block in page.blocks:
+            self._add_block(page_id, block, self.TEXT_WEIGHT, state)
+    
+    def _add_block(self, page_id, block, weight, state):
+        if isinstance(block, Header):
+            weight = max(weight, self.HEADER_WEIGHT)
+        elif isinstance(block, Code):
+            weight = max(weight, self.CODE_WEIGHT)
+        
+        for part in block.parts:
+            if isinstance(part, Block):
+                self._add_block(page_id, part, weight, state)
+            elif isinstance(part, Reference):
+                state['anchor'] = part.get_name()
+                
+                tag, name = part.parse()
+                if tag == '__index__' and name:
+                    self._add_terms(page_id, state['anchor'], name,
+                                    self.REFERENCE_WEIGHT)
+            elif isinstance(part, Image):
+                continue
+            elif isinstance(part, InlineCode):
+                self._add_terms(page_id, state['anchor'], str(part),
+                                max(weight, self.CODE_WEIGHT))
+            else:
+                self._add_terms(page_id, state['anchor'], str(part), weight)
+    
+    def _add_terms(self, page_id, anchor, text, weight):
+        for term in self.TERM_RE.findall(text.lower()):
+            if len(term) >= self.MIN_TERM_LENGTH:
+                self.terms[term][(page_id, anchor)] += weight
+    
+    @staticmethod
+    def get_shard(term):
+        return term[0]
+    
+    def get_files(self):
+        ''' Returns list of pairs of file name (relative to the
+        search directory) and its contents '''
+        shards = defaultdict(dict)
+        for term, postings in self.terms.iteritems():
+            shards[self.get_shard(term)][term] = \
+                sorted(([page_id, anchor, weight]
+                        for (page_id, anchor), weight in postings.iteritems()),
+                       key=lambda posting: (-posting[2], posting[0], posting[1]))
+        
+        meta = {'pages': self.pages,
+                'shards': sorted(shards)}
+        
+        files = [(self.META_NAME + self.SUFFIX, self._compress(meta))]
+        for shard, terms in sorted(shards.items()):
+            files.append((shard + self.SUFFIX, self._compress(terms)))
+        
+        return files
+    
+    @staticmethod
+    def _compress(obj):
+        stream = StringIO()
+        
+        # Zero modification time makes files of unchanged index identical
+        with gzip.GzipFile(fileobj=stream, mode='wb', mtime=0) as f:
+            json.dump(obj, f, separators=(',', ':'), sort_keys=True)
+        
+        return stream.getvalue()